@@ -0,0 +1,22 @@
+"""
+テスト・確認スクリプト共通の設定
+
+.env の読み込みはこのモジュールの初回 import 時の1回だけ行われる
+（以降の import はモジュールキャッシュが返るので再パースしない）。
+"""
+import os
+import types
+from dotenv import load_dotenv
+
+load_dotenv()
+
+CONFIG = types.SimpleNamespace(
+    relation_token=os.environ.get('RELATION_ACCESS_TOKEN'),
+    relation_subdomain=os.environ.get('RELATION_SUBDOMAIN'),
+    relation_message_box_id=os.environ.get('RELATION_MESSAGE_BOX_ID'),
+    supabase_url=os.environ.get('SUPABASE_URL'),
+    supabase_key=os.environ.get('SUPABASE_KEY'),
+    line_channel_secret=os.environ.get('LINE_CHANNEL_SECRET'),
+    line_channel_token=os.environ.get('LINE_CHANNEL_TOKEN'),
+    gemini_api_key=os.environ.get('GEMINI_API_KEY') or os.environ.get('GOOGLE_API_KEY'),
+)
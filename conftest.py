@@ -0,0 +1,23 @@
+"""pytest 共通設定（統合テスト用）"""
+import pytest
+import pytest_asyncio
+
+from test_integration import make_client, warm_up
+
+# 単体実行用のスクリプト（対話入力・負荷テストなど）はテストとして収集しない
+collect_ignore = ["test_line_webhook.py", "test_without_db.py"]
+
+
+@pytest_asyncio.fixture(scope="session", loop_scope="session")
+async def http():
+    """全テストで共有する HTTP クライアント（接続プールをテスト間で使い回す）"""
+    async with make_client() as client:
+        await warm_up(client)
+        yield client
+
+
+@pytest_asyncio.fixture(scope="session", loop_scope="session")
+async def local_server(http):
+    """localhost:8001 のサーバーが必要なテスト用（起動していなければスキップする）"""
+    if not await warm_up(http):
+        pytest.skip("localhost:8001 のサーバーに接続できません")
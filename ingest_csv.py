@@ -1,9 +1,14 @@
-import os, csv, sys, time
+import os, csv, sys, time, hashlib, asyncio
 from argparse import ArgumentParser
 from dotenv import load_dotenv
 load_dotenv()
 
+import numpy as np
 from supabase import create_client
+try:
+    from orjson import loads as json_loads  # 任意: 高速な JSON パーサ
+except ImportError:
+    from json import loads as json_loads
 from google import genai
 from google.genai import types
 
@@ -20,25 +25,61 @@ gclient = genai.Client(api_key=API_KEY)
 Q_KEYS = ["question","Question","質問","問い合わせ","お問い合わせ","問合せ","件名","タイトル","subject","Subject"]
 A_KEYS = ["answer","Answer","回答","返信","返答","response","reply","本文","メッセージ","ボディ"]
 
-def pick(row, keys):
-    for k in keys:
-        if k in row and str(row[k]).strip():
-            return str(row[k]).replace("\u3000"," ").strip()  # 全角スペース除去
+def present_fields(fieldnames, keys) -> list[str]:
+    """候補列のうちCSVヘッダに実在するものだけを優先順に返す（ヘッダ読み込み時に1回だけ呼ぶ）"""
+    return [k for k in keys if k in fieldnames]
+
+def pick(row, fields):
+    for k in fields:
+        v = row[k]
+        if v:
+            v = v.replace("\u3000"," ").strip()  # 全角スペース除去
+            if v:
+                return v
     return ""
 
-def embed(text: str, backoffs=(2,5,10,20,40)) -> list[float]:
+EMBED_MODEL = "gemini-embedding-001"
+EMBED_DIM = 1536
+
+# PostgREST の in.(...) は GET のクエリ文字列に入るので、URL 長の上限（8KB 程度）を超えないよう分割する
+IN_FILTER_CHUNK = 100
+_warned = set()
+
+def warn_once(key: str, msg: str):
+    """同じ key の警告は1回だけ表示する"""
+    if key not in _warned:
+        _warned.add(key)
+        print(msg)
+
+def _chunks(xs: list, n: int):
+    return [xs[i:i + n] for i in range(0, len(xs), n)]
+
+def _parse_vec(x):
+    """embedding_cache.vec（list でも "[...]" の文字列でもOK）を list[float] にする"""
+    if isinstance(x, str):
+        s = x.strip()
+        if not (s.startswith("[") and s.endswith("]")):
+            return None
+        try:
+            x = json_loads(s)
+        except ValueError:
+            return None
+    return x if isinstance(x, list) and len(x) == EMBED_DIM else None
+
+def _embed_remote(texts: list[str], backoffs=(2,5,10,20,40)) -> list[list[float]]:
+    """texts をまとめて1リクエストで埋め込む（429等は待機して再試行）"""
     for i, wait_s in enumerate((0,)+backoffs):
         if wait_s: time.sleep(wait_s)
         try:
             res = gclient.models.embed_content(
-                model="gemini-embedding-001",
-                contents=text,
+                model=EMBED_MODEL,
+                contents=texts,
                 config=types.EmbedContentConfig(
                     task_type="SEMANTIC_SIMILARITY",
-                    output_dimensionality=1536
+                    output_dimensionality=EMBED_DIM
                 )
             )
-            return res.embeddings[0].values
+            return [e.values for e in res.embeddings]
         except Exception as e:
             msg = str(e)
             if "429" in msg or "RESOURCE_EXHAUSTED" in msg or "temporarily" in msg.lower():
@@ -48,84 +89,239 @@ def embed(text: str, backoffs=(2,5,10,20,40)) -> list[float]:
             raise
     raise RuntimeError("埋め込みに失敗（再試行上限）")
 
-def load_existing_contents() -> set[str]:
+def embed_batch(texts: list[str]) -> list[list[float]]:
+    """texts の embedding を順番どおりに返す。embedding_cache にあるものは Gemini を呼ばない"""
+    hashes = [hashlib.sha256(t.encode()).hexdigest() for t in texts]
+    vecs = {}
+    for part in _chunks(list(set(hashes)), IN_FILTER_CHUNK):
+        try:
+            rows = (sb.table("embedding_cache").select("hash, vec")
+                    .in_("hash", part).eq("model", EMBED_MODEL).eq("dim", EMBED_DIM)
+                    .execute().data)
+        except Exception as e:
+            warn_once("embedding_cache", f"[embed] embedding_cache を参照できないため Gemini で計算します: {e}")
+            continue
+        for r in rows:
+            v = _parse_vec(r.get("vec"))
+            if v is not None:
+                vecs[r["hash"]] = v
+
+    misses = {h: t for h, t in zip(hashes, texts) if h not in vecs}
+    if misses:
+        fresh = _embed_remote(list(misses.values()))
+        vecs.update(zip(misses.keys(), fresh))
+        try:
+            sb.table("embedding_cache").upsert(
+                [{"hash": h, "model": EMBED_MODEL, "dim": EMBED_DIM, "vec": vecs[h]} for h in misses],
+                on_conflict="hash,model,dim"
+            ).execute()
+        except Exception as e:
+            warn_once("embedding_cache_write", f"[embed] embedding_cache に保存できませんでした: {e}")
+    return [vecs[h] for h in hashes]
+
+def quantize_i8(v) -> tuple[np.ndarray, float]:
+    """ベクトルを int8 に量子化する（scale = max|v| / 127）。main.py の検索フォールバックと同じ方式"""
+    v = np.asarray(v, dtype=np.float32)
+    scale = float(np.abs(v).max()) / 127 or 1.0
+    return np.round(v / scale).astype(np.int8), scale
+
+def content_hash(content: str) -> str:
+    return hashlib.sha256(content.encode()).hexdigest()
+
+def existing_hashes(hashes: list[str]) -> set[str]:
+    """hashes のうち rag_data に登録済みのものを、content_hash のユニークインデックスへの問い合わせで返す"""
     existing = set()
-    # 必要ならページングする。まずは最大2万件分取得
-    data = sb.table("rag_data").select("content").limit(20000).execute().data
-    for r in data:
-        c = r.get("content")
-        if isinstance(c, str):
-            existing.add(c)
-    print(f"[dedup] 既存: {len(existing)} 件")
+    for part in _chunks(list(set(hashes)), IN_FILTER_CHUNK):
+        try:
+            found = (sb.table("rag_data").select("content_hash")
+                     .in_("content_hash", part).execute().data)
+        except Exception as e:
+            # 判定できなかった行は新規として扱う（重複は upsert の ignore_duplicates で除外される）
+            warn_once("rag_data", f"[dedup] 登録済みかどうかを確認できませんでした: {e}")
+            continue
+        existing.update(r["content_hash"] for r in found)
     return existing
 
-def upsert_row(q: str, a: str):
-    content = f"Q: {q}\nA: {a}"
-    emb = embed(content)
-    sb.table("rag_data").insert({
-        "question": q, "answer": a, "content": content, "embedding": emb
-    }).execute()
-    return content
+def build_rows(pending: list[tuple[str, str, str]], check_existing: bool = True) -> tuple[list[dict], int]:
+    """
+    (q, a, content) のリストを rag_data の行にする。戻り値は (新規行, 既に登録済みで除外した件数)。
+    登録済みの行は embedding を計算しない（呼び出し側で除外済みなら check_existing=False）。
+    """
+    hashes = [content_hash(c) for _, _, c in pending]
+    existing = existing_hashes(hashes) if check_existing else set()
 
-def main():
+    fresh, seen = [], set()
+    for item, h in zip(pending, hashes):
+        if h in existing or h in seen:
+            continue
+        seen.add(h)
+        fresh.append((item, h))
+    if not fresh:
+        return [], len(pending)
+
+    embs = embed_batch([c for (_, _, c), _ in fresh])
+    rows = []
+    for ((q, a, content), h), emb in zip(fresh, embs):
+        # 単位ベクトルで保存すると検索時のコサイン計算が内積だけで済む（元の大きさは norm に残す）
+        v = np.asarray(emb, dtype=np.float32)
+        norm = float(np.linalg.norm(v)) or 1.0
+        unit = v / norm
+        emb_i8, scale = quantize_i8(unit)
+        rows.append({
+            "question": q, "answer": a, "content": content, "content_hash": h,
+            "embedding": unit.tolist(), "norm": norm,
+            "embedding_i8": "\\x" + emb_i8.tobytes().hex(), "scale": scale,
+        })
+    return rows, len(pending) - len(rows)
+
+def upsert_rows(rows: list[dict]) -> int:
+    """
+    rows を1回の upsert で登録し、新規に入った件数を返す。
+    同時実行などで既に入っていた行は rag_data_content_hash_uidx により DB 側で読み飛ばされる。
+    """
+    if not rows:
+        return 0
+    res = sb.table("rag_data").upsert(
+        rows, on_conflict="content_hash", ignore_duplicates=True, returning="minimal", count="exact"
+    ).execute()
+    return res.count if res.count is not None else len(rows)
+
+async def main_async():
     ap = ArgumentParser()
     ap.add_argument("path", nargs="?", default="faq.csv")
     ap.add_argument("--limit", type=int, default=0, help="この件数まで取り込む（0=無制限）")
     ap.add_argument("--skip-valid", type=int, default=0, help="先頭からこの件数の“有効行”を読み飛ばす")
-    ap.add_argument("--sleep-ms", type=int, default=300, help="行ごとの待機(ミリ秒)でレート制限回避")
+    ap.add_argument("--batch-size", type=int, default=100, help="1回の embedding / insert でまとめる行数")
+    ap.add_argument("--concurrency", type=int, default=8, help="同時に embedding を計算するバッチ数")
+    ap.add_argument("--sleep-ms", type=int, default=300, help="embedding バッチを開始する最小間隔(ミリ秒)。全ワーカー共通でレート制限回避")
     ap.add_argument("--dry-run", action="store_true", help="DBへ挿入せず検証のみ")
     args = ap.parse_args()
 
-    existing = set()
-    if not args.dry_run:
-        existing = load_existing_contents()
-
-    valid = skipped = inserted = dedup = 0
+    valid = skipped = queued = inserted = dedup = 0
     skipped_examples = 0
 
-    with open(args.path, newline="", encoding="utf-8") as f:
-        reader = csv.DictReader(f)
-        if reader.fieldnames is None:
-            raise SystemExit("CSVのヘッダ行がありません。1行目を '質問,回答' または 'question,answer' にしてください。")
-        print("columns:", reader.fieldnames)
-
-        for i, row in enumerate(reader, start=1):
-            q = pick(row, Q_KEYS)
-            a = pick(row, A_KEYS)
-            if not q or not a:
-                if skipped_examples < 20:
-                    print(f"skip: 行{i} 必須列不足（Q/A） q='{q[:20]}' a='{a[:20]}'")
-                    skipped_examples += 1
-                skipped += 1
+    # read_csv → read_q → embedder(×N) → write_q → writer の3段パイプライン
+    n_embedders = max(args.concurrency, 1)
+    read_q = asyncio.Queue(maxsize=4 * args.batch_size)
+    write_q = asyncio.Queue(maxsize=4)
+
+    # --limit 指定時は登録済みの行を件数に数えないよう、登録済みかどうかを読み込み段階で判定する
+    # （build_rows では再判定しない。チャンクをまたぐ重複は upsert の ignore_duplicates に任せる）
+    chunk = []
+
+    async def flush_chunk() -> bool:
+        """chunk の未登録行だけを read_q に流す。limit に達したら True"""
+        nonlocal queued, dedup
+        hashes = [content_hash(c) for _, _, c in chunk]
+        existing = await asyncio.to_thread(existing_hashes, hashes)
+        seen = set()
+        for item, h in zip(chunk, hashes):
+            if h in existing or h in seen:
+                dedup += 1
                 continue
+            seen.add(h)
+            await read_q.put(item)
+            queued += 1
+            if queued >= args.limit:
+                break
+        chunk.clear()
+        return queued >= args.limit
+
+    async def read_csv():
+        nonlocal valid, skipped, queued, skipped_examples
+        with open(args.path, newline="", encoding="utf-8") as f:
+            reader = csv.DictReader(f)
+            if reader.fieldnames is None:
+                raise SystemExit("CSVのヘッダ行がありません。1行目を '質問,回答' または 'question,answer' にしてください。")
+            print("columns:", reader.fieldnames)
+            q_fields = present_fields(reader.fieldnames, Q_KEYS)
+            a_fields = present_fields(reader.fieldnames, A_KEYS)
+            if not q_fields or not a_fields:
+                raise SystemExit("質問列または回答列が見つかりません。1行目を '質問,回答' または 'question,answer' にしてください。")
+
+            for i, row in enumerate(reader, start=1):
+                q = pick(row, q_fields)
+                a = pick(row, a_fields)
+                if not q or not a:
+                    if skipped_examples < 20:
+                        print(f"skip: 行{i} 必須列不足（Q/A） q='{q[:20]}' a='{a[:20]}'")
+                        skipped_examples += 1
+                    skipped += 1
+                    continue
+
+                # 有効行カウントに基づく読み飛ばし
+                if valid < args.skip_valid:
+                    valid += 1
+                    continue
 
-            # 有効行カウントに基づく読み飛ばし
-            if valid < args.skip_valid:
                 valid += 1
-                continue
 
-            valid += 1
+                content = f"Q: {q}\nA: {a}"
+                if args.dry_run:
+                    continue
+                if not args.limit:
+                    await read_q.put((q, a, content))
+                    queued += 1
+                    continue
+                chunk.append((q, a, content))
+                if len(chunk) >= args.batch_size and await flush_chunk():
+                    break
+            else:
+                if chunk:
+                    await flush_chunk()
+
+        for _ in range(n_embedders):
+            await read_q.put(None)
 
-            content = f"Q: {q}\nA: {a}"
-            if not args.dry_run and content in existing:
-                dedup += 1
-                continue
+    # --sleep-ms は全 embedder で共有する開始間隔。ワーカー数を増やしても Gemini への要求レートは変わらない
+    rate_lock = asyncio.Lock()
+    next_start = 0.0
 
-            if not args.dry_run:
-                upsert_row(q, a)
-                existing.add(content)
-                inserted += 1
-                if inserted % 5 == 0:
-                    print(f"...{inserted} inserted")
+    async def wait_rate_slot():
+        nonlocal next_start
+        async with rate_lock:
+            loop_time = asyncio.get_running_loop().time
+            delay = next_start - loop_time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            next_start = loop_time() + args.sleep_ms / 1000.0
 
+    async def embedder():
+        # embedding は同期 API なのでスレッドで実行する。同時実行数は embedder の数、要求レートは --sleep-ms で抑える
+        done = False
+        while not done:
+            batch = []
+            while len(batch) < args.batch_size:
+                item = await read_q.get()
+                if item is None:
+                    done = True
+                    break
+                batch.append(item)
+            if batch:
                 if args.sleep_ms > 0:
-                    time.sleep(args.sleep_ms / 1000.0)
+                    await wait_rate_slot()
+                await write_q.put(await asyncio.to_thread(build_rows, batch, not args.limit))
 
-                if args.limit and inserted >= args.limit:
-                    break
+    async def embedders():
+        await asyncio.gather(*(embedder() for _ in range(n_embedders)))
+        await write_q.put(None)
+
+    async def writer():
+        nonlocal inserted, dedup
+        while (item := await write_q.get()) is not None:
+            rows, n_existing = item
+            n = await asyncio.to_thread(upsert_rows, rows)
+            inserted += n
+            dedup += n_existing + len(rows) - n
+            print(f"...{inserted} inserted")
+
+    await asyncio.gather(read_csv(), embedders(), writer())
 
     print(f"result: valid(after-skip)={max(valid - args.skip_valid, 0)}, "
           f"skipped(blank)={skipped}, dedup={dedup}, inserted={inserted}")
 
+def main():
+    asyncio.run(main_async())
+
 if __name__ == "__main__":
     main()
@@ -2,15 +2,34 @@
 from dotenv import load_dotenv
 load_dotenv()
 
-import os, json, hmac, hashlib, base64, logging
+import os, re, json, hmac, hashlib, base64, logging, time, asyncio, threading
 from fastapi import FastAPI, Request, HTTPException
 from pydantic import BaseModel
 import numpy as np
+try:
+    import simsimd  # 任意: AVX-512 / NEON のコサインカーネル
+except ImportError:
+    simsimd = None
+try:
+    from orjson import loads as json_loads  # 任意: 高速な JSON パーサ
+except ImportError:
+    json_loads = json.loads
+try:
+    import ahocorasick  # 任意: NGワードの多パターン照合（pyahocorasick）
+except ImportError:
+    ahocorasick = None
+try:
+    import hyperscan  # 任意: NGワード / NGパターンの SIMD 照合
+except ImportError:
+    hyperscan = None
 from supabase import create_client
 from google import genai
 from google.genai import types
 import httpx
+from datetime import datetime, timezone
+from functools import lru_cache
 from typing import Optional, Dict, Any
+from cachetools import TTLCache
 
 # Re:lation統合のインポート
 from relation_integration_fixed import create_relation_service_from_env, RelationAPIError
@@ -50,73 +69,301 @@ STYLE = os.getenv("REPLY_STYLE", """
 # ====== NGワードガード（任意） ======
 RAW_NG = os.getenv("NG_WORDS", "返金,100%,永久無料,必ず,保証").strip()
 NG_WORDS = [w.strip() for w in RAW_NG.split(",") if w.strip()]
+# 正規表現のNGパターン（カンマ区切り。例: 100\s*%,永久.*無料）
+RAW_NG_PATTERNS = os.getenv("NG_PATTERNS", "").strip()
+NG_PATTERNS = [p.strip() for p in RAW_NG_PATTERNS.split(",") if p.strip()]
 FLAG_PREFIX = os.getenv("FLAG_PREFIX", "【確認が必要です】")
 
+def _build_ng_database(words: list[str], patterns: list[str]):
+    """NGワード（リテラル）とNGパターンを1つの Hyperscan データベースにまとめる（hyperscan が無ければ None）"""
+    if hyperscan is None or not (words or patterns):
+        return None
+    expressions = [re.escape(w).encode() for w in words] + [p.encode() for p in patterns]
+    db = hyperscan.Database()
+    db.compile(
+        expressions=expressions,
+        ids=list(range(len(expressions))),
+        elements=len(expressions),
+        flags=[hyperscan.HS_FLAG_UTF8 | hyperscan.HS_FLAG_SINGLEMATCH] * len(expressions),
+    )
+    return db
+
+def _build_ng_automaton(words: list[str]):
+    """NGワードを Aho-Corasick オートマトンにまとめる（pyahocorasick が無ければ None）"""
+    if ahocorasick is None or not words:
+        return None
+    automaton = ahocorasick.Automaton()
+    for w in words:
+        automaton.add_word(w, w)
+    automaton.make_automaton()
+    return automaton
+
+_NG_DATABASE = _build_ng_database(NG_WORDS, NG_PATTERNS)
+_NG_DATABASE_LOCK = threading.Lock()  # Hyperscan の scratch はスレッド間で共有できない
+_NG_AUTOMATON = _build_ng_automaton(NG_WORDS) if _NG_DATABASE is None else None
+_NG_REGEX = (re.compile("|".join(f"(?:{p})" for p in NG_PATTERNS))
+             if NG_PATTERNS and _NG_DATABASE is None else None)
+
+def _has_ng(text: str) -> bool:
+    if _NG_DATABASE is not None:
+        # NGワードとNGパターンを1回のスキャンでまとめて照合する
+        hits = []
+        with _NG_DATABASE_LOCK:
+            _NG_DATABASE.scan(text.encode(), match_event_handler=lambda *_: hits.append(True))
+        return bool(hits)
+
+    if _NG_AUTOMATON is not None:
+        # 1回の走査で全NGワードを照合する
+        hit = next(_NG_AUTOMATON.iter(text), None) is not None
+    else:
+        hit = any(ng in text for ng in NG_WORDS)
+    return hit or (_NG_REGEX is not None and _NG_REGEX.search(text) is not None)
+
 def guard(user_text: str, reply_text: str) -> str:
     combined = f"{user_text}\n{reply_text}"
-    if any(ng in combined for ng in NG_WORDS):
+    if _has_ng(combined):
         return f"{FLAG_PREFIX}\n{reply_text}"
     return reply_text
 
 # ====== Embedding（1536次元でDBに合わせる） ======
+EMBED_MODEL = "gemini-embedding-001"
+EMBED_DIM = 1536
+
+def _text_hash(text: str) -> str:
+    return hashlib.sha256(text.encode()).hexdigest()
+
+@lru_cache(maxsize=4096)
 def embed(text: str) -> list[float]:
+    """
+    テキストの embedding を返す。
+    プロセス内は lru_cache、プロセス間は embedding_cache テーブル（hash, model, dim）で再利用する。
+    """
+    h = _text_hash(text)
+    try:
+        rows = (sb.table("embedding_cache").select("vec")
+                .eq("hash", h).eq("model", EMBED_MODEL).eq("dim", EMBED_DIM)
+                .limit(1).execute().data)
+    except Exception:
+        rows = []
+    if rows:
+        v = _to_vec(rows[0].get("vec"))
+        if v is not None and v.size == EMBED_DIM:
+            return v.tolist()
+
     res = gclient.models.embed_content(
-        model="gemini-embedding-001",
+        model=EMBED_MODEL,
         contents=text,
         config=types.EmbedContentConfig(
             task_type="SEMANTIC_SIMILARITY",
-            output_dimensionality=1536
+            output_dimensionality=EMBED_DIM
         )
     )
-    return res.embeddings[0].values
+    vec = res.embeddings[0].values
+    try:
+        sb.table("embedding_cache").upsert(
+            {"hash": h, "model": EMBED_MODEL, "dim": EMBED_DIM, "vec": vec},
+            on_conflict="hash,model,dim"
+        ).execute()
+    except Exception:
+        pass
+    return vec
 
-# ====== 類似検索（Supabaseからの戻りが list でも str でもOKにする） ======
+# ====== 類似検索（pgvector の match_rag RPC で上位k件だけ受け取る） ======
 def search_similar(vec: list[float], k: int = 5) -> list[str]:
     """
-    rag_data の content/embedding からコサイン類似度で上位k件を返す。
-    embedding が list でも "[...]" の文字列でも正しく処理する。
+    rag_data からコサイン類似度で上位k件の content を返す。
+    スコア計算と並び替えは DB 側（match_rag 関数 + HNSW インデックス）で行う。
     """
-    rows = sb.table("rag_data").select("content, embedding").limit(2000).execute().data
-    if not rows:
-        return []
+    try:
+        rows = sb.rpc("match_rag", {"query_embedding": vec, "match_count": k}).execute().data
+    except Exception:
+        # match_rag が未作成の環境ではローカル行列で全件スコアリング
+        return search_similar_local(vec, k)
+    return [r["content"] for r in rows or []]
 
-    q = np.array(vec, dtype=np.float32)
+# ====== ローカル類似検索（RPC が使えない場合のフォールバック） ======
+RAG_CACHE_TTL = int(os.getenv("RAG_CACHE_TTL", "300"))  # 秒。rag_data を再取得する間隔
+_rag_index = None  # {"expires", "M", "contents"} を丸ごと差し替えて使う
+_rag_schema_warned = False  # 旧スキーマ（embedding_i8 等の列なし）の警告を出したか
 
-    def to_vec(x):
-        # そのまま配列で来るケース
-        if isinstance(x, list):
+def _to_vec(x):
+    """Supabase からの embedding（list でも "[...]" の文字列でもOK）を float32 配列にする"""
+    # そのまま配列で来るケース
+    if isinstance(x, list):
+        try:
+            return np.array(x, dtype=np.float32)
+        except Exception:
+            return None
+    # 文字列 "[0.12, -0.34, ...]" で来るケース
+    if isinstance(x, str):
+        s = x.strip()
+        if s.startswith('[') and s.endswith(']'):
             try:
-                return np.array(x, dtype=np.float32)
+                return np.asarray(json_loads(s), dtype=np.float32)
             except Exception:
                 return None
-        # 文字列 "[0.12, -0.34, ...]" で来るケース
-        if isinstance(x, str):
-            s = x.strip()
-            if s.startswith('[') and s.endswith(']'):
-                try:
-                    return np.fromstring(s[1:-1], sep=',', dtype=np.float32)
-                except Exception:
-                    return None
+    return None
+
+def quantize_i8(v) -> tuple[np.ndarray, float]:
+    """ベクトルを int8 に量子化する（scale = max|v| / 127）"""
+    v = np.asarray(v, dtype=np.float32)
+    scale = float(np.abs(v).max()) / 127 or 1.0
+    return np.round(v / scale).astype(np.int8), scale
+
+def _from_bytea(x):
+    """PostgREST の bytea（"\\x..." の16進文字列）を int8 配列にする"""
+    if not isinstance(x, str) or not x.startswith("\\x"):
         return None
+    try:
+        return np.frombuffer(bytes.fromhex(x[2:]), dtype=np.int8)
+    except ValueError:
+        return None
+
+def _load_rag_index() -> dict:
+    """
+    rag_data を取得して (N, EMBED_DIM) の int8 行列にまとめる（TTL付きキャッシュ）。
+    取り込み時に単位ベクトル化・ノルム保存済みの行はそのまま使い、
+    正規化前の行や embedding_i8 が未作成の古い行だけその場で正規化・量子化する。
+    列追加の ALTER を適用していない旧スキーマでは、全行を embedding から量子化する。
+    """
+    global _rag_index, _rag_schema_warned
+    idx = _rag_index
+    now = time.time()
+    if idx is not None and now < idx["expires"]:
+        return idx
 
-    scored = []
+    vecs, scales, contents = [], [], []
+    try:
+        rows = (sb.table("rag_data").select("content, embedding_i8, scale, norm")
+                .limit(2000).execute().data or [])
+    except Exception as e:
+        if not _rag_schema_warned:
+            print(f"[RAG] embedding_i8 列を取得できないため embedding から量子化します（README の ALTER を適用してください）: {e}")
+            _rag_schema_warned = True
+        rows = None
+
+    legacy = []
+    if rows is None:
+        legacy = (sb.table("rag_data").select("content, embedding")
+                  .limit(2000).execute().data or [])
+        rows = []
     for r in rows:
-        v = to_vec(r.get("embedding"))
-        if v is None or v.size == 0:
+        v = _from_bytea(r.get("embedding_i8"))
+        if v is None or v.size != EMBED_DIM:
+            continue
+        vecs.append(v)
+        if r.get("norm") is not None and r.get("scale"):
+            # 単位ベクトルを量子化した行: v * scale がそのまま単位ベクトル
+            scales.append(float(r["scale"]))
+        else:
+            scales.append(1.0 / (float(np.linalg.norm(v.astype(np.float32))) or 1.0))
+        contents.append(r["content"])
+
+    if len(rows) > len(vecs):
+        legacy = (sb.table("rag_data").select("content, embedding")
+                  .is_("embedding_i8", "null").limit(2000).execute().data or [])
+    for r in legacy:
+        v = _to_vec(r.get("embedding"))
+        if v is None or v.size != EMBED_DIM:
             continue
-        denom = (np.linalg.norm(q) + 1e-9) * (np.linalg.norm(v) + 1e-9)
-        score = float(np.dot(q, v) / denom)
-        scored.append((score, r["content"]))
+        v_i8, scale = quantize_i8(v / (float(np.linalg.norm(v)) or 1.0))
+        vecs.append(v_i8)
+        scales.append(scale)
+        contents.append(r["content"])
 
-    if not scored:
+    M = np.vstack(vecs) if vecs else np.empty((0, EMBED_DIM), dtype=np.int8)
+    if simsimd is None:
+        # NumPy だけの環境では単位ベクトル（float32）に戻しておき、スコアを内積だけで求める
+        M = M.astype(np.float32) * np.asarray(scales, dtype=np.float32)[:, None]
+    idx = {
+        "expires": now + RAG_CACHE_TTL,
+        "M": np.ascontiguousarray(M),
+        "contents": contents,
+    }
+    _rag_index = idx
+    return idx
+
+def _cosine_scores(q: np.ndarray, idx: dict) -> np.ndarray:
+    """q と行列の全行のコサイン類似度。SimSIMD があれば int8 のまま dot とノルムを1パスで計算する"""
+    M = idx["M"]
+    if simsimd is not None:
+        # 行列が int8 なのでクエリも int8 にそろえて VNNI の int8 カーネルを使う
+        q_i8, _ = quantize_i8(q)
+        return 1 - np.asarray(simsimd.cdist(q_i8.reshape(1, -1), M, metric="cosine")).ravel()
+    # 行は単位ベクトルなので、クエリを正規化すれば内積がそのままコサイン類似度
+    return M @ (q / (np.linalg.norm(q) + 1e-9))
+
+def search_similar_local(vec: list[float], k: int = 5) -> list[str]:
+    """キャッシュした行列に対して 1 回の行列ベクトル積でコサイン類似度を計算し、上位k件を返す"""
+    idx = _load_rag_index()
+    M = idx["M"]
+    if M.shape[0] == 0:
         return []
-    scored.sort(reverse=True, key=lambda t: t[0])
-    return [content for _, content in scored[:k]]
+
+    q = np.asarray(vec, dtype=np.float32)
+    scores = _cosine_scores(q, idx)
+    if k < scores.size:
+        # 全件ソートせず O(N) で上位k件を選び、k件だけ並べ替える
+        top = np.argpartition(-scores, k)[:k]
+        top = top[np.argsort(-scores[top])]
+    else:
+        top = np.argsort(-scores)
+    return [idx["contents"][i] for i in top]
+
+# ====== 返答キャッシュ（同じ・ほぼ同じ質問は embedding / Gemini を呼ばずに返す） ======
+REPLY_CACHE_TTL = int(os.getenv("REPLY_CACHE_TTL", "86400"))  # 秒
+REPLY_CACHE_THRESHOLD = float(os.getenv("REPLY_CACHE_THRESHOLD", "0.97"))
+
+def _reply_cache_cutoff() -> str:
+    return datetime.fromtimestamp(time.time() - REPLY_CACHE_TTL, tz=timezone.utc).isoformat()
+
+def reply_cache_get(text_hash: str) -> Optional[str]:
+    """完全一致（テキストの SHA-256）でキャッシュ済みの返答を探す"""
+    try:
+        rows = (sb.table("reply_cache").select("reply").eq("text_hash", text_hash)
+                .gte("created_at", _reply_cache_cutoff()).limit(1).execute().data)
+    except Exception:
+        return None
+    return rows[0]["reply"] if rows else None
+
+def reply_cache_match(vec: list[float]) -> Optional[str]:
+    """embedding のコサイン類似度が閾値を超えるキャッシュ済みの返答を探す"""
+    try:
+        rows = sb.rpc("match_reply", {
+            "query_embedding": vec,
+            "match_threshold": REPLY_CACHE_THRESHOLD,
+            "match_count": 1,
+            "min_created_at": _reply_cache_cutoff(),
+        }).execute().data
+    except Exception:
+        return None
+    return rows[0]["reply"] if rows else None
+
+def reply_cache_put(text_hash: str, vec: Optional[list[float]], reply: str):
+    try:
+        sb.table("reply_cache").upsert({
+            "text_hash": text_hash,
+            "embedding": vec,
+            "reply": reply,
+            "created_at": datetime.now(timezone.utc).isoformat(),
+        }, on_conflict="text_hash").execute()
+    except Exception:
+        pass
 
 # ====== 回答生成（RAG + スタイル + ガード） ======
 def gen_reply(user_text: str) -> str:
+    # キャッシュにはガード前の返答を保存し、NGワード判定は毎回その時点の質問文で行う
+    text_hash = _text_hash(user_text)
+    cached = reply_cache_get(text_hash)
+    if cached:
+        return guard(user_text, cached)
+
+    qvec = None
     try:
         qvec = embed(user_text)
+        cached = reply_cache_match(qvec)
+        if cached:
+            return guard(user_text, cached)
         examples = search_similar(qvec)
     except Exception:
         # 何かあっても落ちないように
@@ -140,7 +387,9 @@ def gen_reply(user_text: str) -> str:
     except Exception:
         reply = ""
 
-    if not reply:
+    if reply:
+        reply_cache_put(text_hash, qvec, reply)
+    else:
         reply = "お問い合わせありがとうございます。内容を確認のうえ、担当よりご連絡いたします。"
     return guard(user_text, reply)
 
@@ -287,12 +536,97 @@ def post_reply(q: Q):
         }
 
 # ====== LINE Webhook（Re:lation統合対応） ======
+# LINE API 用の HTTP クライアント（接続を使い回して TLS ハンドシェイクを省く）
+_line_http = httpx.AsyncClient(
+    timeout=15,
+    http2=True,
+    headers={"Authorization": f"Bearer {os.getenv('LINE_CHANNEL_TOKEN','')}"},
+)
+
+# Webhook は即座に 200 を返し、イベント処理はバックグラウンドで行う（同時処理数は上限付き）
+LINE_MAX_CONCURRENCY = int(os.getenv("LINE_MAX_CONCURRENCY", "8"))
+_line_sem = asyncio.Semaphore(LINE_MAX_CONCURRENCY)
+_line_tasks: set = set()  # 実行中タスクの参照を保持（GC で消えないように）
+
+@app.on_event("shutdown")
+async def _close_line_http():
+    # 処理中のイベントを返信し終えてから接続を閉じる
+    await asyncio.gather(*_line_tasks, return_exceptions=True)
+    await _line_http.aclose()
+
 def verify_line(body: bytes, sig: str) -> bool:
     secret = os.getenv("LINE_CHANNEL_SECRET", "").encode()
     if not secret or not sig:
         return False
-    mac = hmac.new(secret, body, hashlib.sha256).digest()
-    return base64.b64encode(mac).decode() == sig
+    # hmac.digest は OpenSSL のワンショット HMAC を直接呼ぶ（HMAC オブジェクトを作らない）
+    mac = hmac.digest(secret, body, "sha256")
+    return hmac.compare_digest(base64.b64encode(mac), sig.encode())
+
+# 表示名はめったに変わらないので userId ごとに1時間キャッシュする
+_profile_cache = TTLCache(maxsize=10_000, ttl=3600)
+
+async def fetch_display_name(user_id: str) -> Optional[str]:
+    """LINEユーザーの表示名を取得（失敗時は None）"""
+    if user_id in _profile_cache:
+        return _profile_cache[user_id]
+    try:
+        profile_response = await _line_http.get(f"https://api.line.me/v2/bot/profile/{user_id}")
+        if profile_response.status_code == 200:
+            profile_data = profile_response.json()
+            display_name = profile_data.get("displayName")
+            _profile_cache[user_id] = display_name
+            return display_name
+    except Exception:
+        logger.warning("LINEユーザープロファイル取得に失敗")
+    return None
+
+async def handle_line_event(ev: Dict[str, Any]):
+    """LINEイベント1件の処理（回答生成と Re:lation 連携を並行して行う）"""
+    if not (ev.get("type") == "message" and ev["message"]["type"] == "text"):
+        return
+
+    user_id = ev["source"]["userId"]
+    message_text = ev["message"]["text"]
+
+    async def relation_task() -> Dict[str, Any]:
+        # Re:lation統合処理（チケット件名に表示名を使うのでプロファイル取得の後に行う）
+        display_name = await fetch_display_name(user_id)
+        return await asyncio.to_thread(process_with_relation, user_id, message_text, display_name)
+
+    # 基本回答生成と Re:lation 連携は互いに独立なので同時に進める
+    basic_answer, relation_result = await asyncio.gather(
+        asyncio.to_thread(gen_reply, message_text),
+        relation_task(),
+    )
+
+    # 最終回答の決定
+    if relation_result.get("ticket_created"):
+        # チケットが作成された場合
+        final_answer = f"{basic_answer}\n\n{relation_result['message']}"
+        logger.info(f"LINEユーザー {user_id} のチケットを作成: {relation_result.get('ticket_id')}")
+    elif relation_result.get("error"):
+        # Re:lationでエラーが発生した場合
+        final_answer = f"{basic_answer}\n\n※サポートシステムで一時的な問題が発生していますが、お問い合わせは確認させていただきます。"
+        logger.warning(f"Re:lationエラーが発生: {relation_result['error']}")
+    else:
+        # 通常回答
+        final_answer = basic_answer
+
+    # LINE返信
+    await _line_http.post("https://api.line.me/v2/bot/message/reply",
+        json={"replyToken": ev["replyToken"],
+              "messages": [{"type": "text", "text": final_answer}]})
+
+async def process_line_events(events: list):
+    """イベント同士は独立しているので並行処理する（同時処理数は LINE_MAX_CONCURRENCY まで）"""
+    async def run(ev):
+        async with _line_sem:
+            await handle_line_event(ev)
+
+    results = await asyncio.gather(*(run(ev) for ev in events), return_exceptions=True)
+    for r in results:
+        if isinstance(r, Exception):
+            logger.error(f"LINEイベント処理エラー: {r}")
 
 @app.post("/line")
 async def line_webhook(req: Request):
@@ -301,55 +635,9 @@ async def line_webhook(req: Request):
         raise HTTPException(403, "bad signature")
 
     data = json.loads(body.decode())
-    for ev in data.get("events", []):
-        if ev.get("type") == "message" and ev["message"]["type"] == "text":
-            user_id = ev["source"]["userId"]
-            message_text = ev["message"]["text"]
-            
-            # ユーザー情報取得（可能であれば）
-            display_name = None
-            try:
-                async with httpx.AsyncClient(timeout=15) as c:
-                    profile_response = await c.get(
-                        f"https://api.line.me/v2/bot/profile/{user_id}",
-                        headers={"Authorization": f"Bearer {os.getenv('LINE_CHANNEL_TOKEN','')}"}
-                    )
-                    if profile_response.status_code == 200:
-                        profile_data = profile_response.json()
-                        display_name = profile_data.get("displayName")
-            except Exception:
-                logger.warning("LINEユーザープロファイル取得に失敗")
-            
-            # Re:lation統合処理
-            relation_result = process_with_relation(
-                user_id=user_id,
-                message=message_text,
-                display_name=display_name
-            )
-            
-            # 基本回答生成
-            basic_answer = gen_reply(message_text)
-            
-            # 最終回答の決定
-            if relation_result.get("ticket_created"):
-                # チケットが作成された場合
-                final_answer = f"{basic_answer}\n\n{relation_result['message']}"
-                logger.info(f"LINEユーザー {user_id} のチケットを作成: {relation_result.get('ticket_id')}")
-            elif relation_result.get("error"):
-                # Re:lationでエラーが発生した場合
-                final_answer = f"{basic_answer}\n\n※サポートシステムで一時的な問題が発生していますが、お問い合わせは確認させていただきます。"
-                logger.warning(f"Re:lationエラーが発生: {relation_result['error']}")
-            else:
-                # 通常回答
-                final_answer = basic_answer
-            
-            # LINE返信
-            async with httpx.AsyncClient(timeout=15) as c:
-                await c.post("https://api.line.me/v2/bot/message/reply",
-                    headers={"Authorization": f"Bearer {os.getenv('LINE_CHANNEL_TOKEN','')}"},
-                    json={"replyToken": ev["replyToken"],
-                          "messages": [{"type": "text", "text": final_answer}]})
-    
+    task = asyncio.create_task(process_line_events(data.get("events", [])))
+    _line_tasks.add(task)
+    task.add_done_callback(_line_tasks.discard)
     return "ok"
 
 # ========== デバッグ用エンドポイント ==========
@@ -4,19 +4,47 @@ Re:lation API 調査・テスト用スクリプト
 404エラーの原因を特定し、正しいAPI呼び出し方法を確立する
 """
 
+import io
 import os
 import json
+import asyncio
+import traceback
+from datetime import datetime
+from pathlib import Path
+import httpx
 import requests
-from typing import Dict, Any, Optional
+from requests.adapters import HTTPAdapter
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Any, List, Optional, Tuple
 from dotenv import load_dotenv
 
 # 環境変数を読み込み
 load_dotenv()
 
+# 同時に投げる調査リクエストの上限（接続プールの大きさと揃える）
+MAX_PARALLEL_PROBES = 8
+
 class RelationAPIInvestigator:
     """Re:lation API の調査・テスト用クラス"""
     
-    def __init__(self):
+    # 404 診断で試す URL パターン（{sd}: サブドメイン, {mb}: メッセージボックスID）
+    _URL_PATTERN_TEMPLATES = (
+        ("v1_api", "https://{sd}.relationapp.jp/api/v1/message_boxes"),
+        ("v2_api", "https://{sd}.relationapp.jp/api/v2/message_boxes"),
+        ("with_message_box", "https://{sd}.relationapp.jp/api/v2/{mb}/users"),
+        ("root_check", "https://{sd}.relationapp.jp/"),
+    )
+    
+    # 404 診断で試す認証ヘッダー（{token}: アクセストークン）
+    _AUTH_VARIATIONS = (
+        ("Authorization", "Bearer {token}"),
+        ("Authorization", "Token {token}"),
+        ("X-API-Token", "{token}"),
+        ("Authorization", "{token}"),
+    )
+    
+    def __init__(self, verbose: bool = False):
+        self.verbose = verbose
         self.access_token = os.getenv("RELATION_ACCESS_TOKEN")
         self.subdomain = os.getenv("RELATION_SUBDOMAIN") 
         self.message_box_id = os.getenv("RELATION_MESSAGE_BOX_ID")
@@ -33,6 +61,29 @@ class RelationAPIInvestigator:
             "Content-Type": "application/json",
             "User-Agent": "Re:lation-API-Investigation/1.0"
         }
+        # ヘッダーは不変なので表示用の文字列は一度だけ作る（トークンは伏せる）
+        self._headers_repr = json.dumps(
+            {**self.headers, "Authorization": "Bearer ***"}, indent=2, ensure_ascii=False
+        )
+        
+        self.session = self._create_session()
+        
+        # 診断用の URL・認証パターンは設定値が決まった時点で一度だけ組み立てる
+        self._url_patterns = [
+            (name, tpl.format(sd=self.subdomain, mb=self.message_box_id))
+            for name, tpl in self._URL_PATTERN_TEMPLATES
+        ]
+        self._auth_variations = [
+            {header: tpl.format(token=self.access_token)}
+            for header, tpl in self._AUTH_VARIATIONS
+        ]
+    
+    def _create_session(self) -> requests.Session:
+        """同じホストへの調査リクエストで TCP/TLS 接続を使い回すセッション"""
+        session = requests.Session()
+        session.headers.update(self.headers)
+        session.mount("https://", HTTPAdapter(pool_connections=1, pool_maxsize=MAX_PARALLEL_PROBES))
+        return session
     
     def _validate_config(self):
         """必要な設定値の確認"""
@@ -50,161 +101,166 @@ class RelationAPIInvestigator:
     
     def test_api_connectivity(self) -> Dict[str, Any]:
         """API接続テスト - 最も基本的なエンドポイントをテスト"""
-        results = {}
-        
-        # 1. 受信箱一覧取得 (message_box_id不要)
-        results['inbox_list'] = self._test_endpoint(
-            "GET", 
-            f"{self.base_url}/message_boxes",
-            description="受信箱一覧取得"
-        )
-        
-        # 2. ユーザー一覧取得 (message_box_id必要)
-        results['user_list'] = self._test_endpoint(
-            "GET",
-            f"{self.base_url}/{self.message_box_id}/users", 
-            description="ユーザー一覧取得"
-        )
-        
-        # 3. チケット分類一覧取得
-        results['case_categories'] = self._test_endpoint(
-            "GET",
-            f"{self.base_url}/{self.message_box_id}/case_categories",
-            description="チケット分類一覧取得"
-        )
-        
-        # 4. ラベル一覧取得
-        results['labels'] = self._test_endpoint(
-            "GET", 
-            f"{self.base_url}/{self.message_box_id}/labels",
-            description="ラベル一覧取得"
-        )
+        return self._run_probes(self._connectivity_probes())
+    
+    def _connectivity_probes(self) -> List[Tuple[str, str, str, str]]:
+        """接続テストで叩く (key, method, url, description) の一覧"""
+        return [
+            # 1. 受信箱一覧取得 (message_box_id不要)
+            ("inbox_list", "GET", f"{self.base_url}/message_boxes", "受信箱一覧取得"),
+            # 2. ユーザー一覧取得 (message_box_id必要)
+            ("user_list", "GET", f"{self.base_url}/{self.message_box_id}/users", "ユーザー一覧取得"),
+            # 3. チケット分類一覧取得
+            ("case_categories", "GET", f"{self.base_url}/{self.message_box_id}/case_categories", "チケット分類一覧取得"),
+            # 4. ラベル一覧取得
+            ("labels", "GET", f"{self.base_url}/{self.message_box_id}/labels", "ラベル一覧取得"),
+        ]
+    
+    def _run_probes(self, probes: List[Tuple[str, str, str, str]]) -> Dict[str, Any]:
+        """(key, method, url, description) の各プローブを並列に実行し、結果は登録順に表示する"""
+        with ThreadPoolExecutor(max_workers=MAX_PARALLEL_PROBES) as executor:
+            futures = [
+                (key, method, url, description, executor.submit(self._test_endpoint, method, url, description))
+                for key, method, url, description in probes
+            ]
         
+        results = {}
+        for key, method, url, description, future in futures:
+            results[key] = future.result()
+            self._print_probe(method, url, description, results[key])
         return results
     
-    def _test_endpoint(self, method: str, url: str, description: str, data: Optional[Dict] = None) -> Dict[str, Any]:
-        """個別エンドポイントのテスト"""
+    def _test_endpoint(
+        self,
+        method: str,
+        url: str,
+        description: str,
+        data: Optional[Dict] = None,
+        extra_headers: Optional[Dict[str, str]] = None
+    ) -> Dict[str, Any]:
+        """個別エンドポイントのテスト（表示は行わず結果だけを返す）
+        
+        extra_headers はセッションの共通ヘッダーに上書きして送る（認証ヘッダーの差し替え診断用）。
+        """
         try:
-            print(f"\n🔍 テスト中: {description}")
-            print(f"   Method: {method}")
-            print(f"   URL: {url}")
-            print(f"   Headers: {json.dumps(self.headers, indent=2, ensure_ascii=False)}")
-            
-            if method.upper() == "GET":
-                response = requests.get(url, headers=self.headers, timeout=30)
-            elif method.upper() == "POST":
-                response = requests.post(url, headers=self.headers, json=data, timeout=30)
-            elif method.upper() == "PUT":
-                response = requests.put(url, headers=self.headers, json=data, timeout=30)
-            else:
+            if method.upper() not in ("GET", "POST", "PUT"):
                 return {"error": f"未対応のHTTPメソッド: {method}"}
-            
-            result = {
-                "status_code": response.status_code,
-                "success": response.status_code < 400,
-                "headers": dict(response.headers),
-                "url": response.url,
-                "description": description
-            }
-            
-            # レスポンス本文の処理
-            try:
-                result["response"] = response.json()
-            except json.JSONDecodeError:
-                result["response_text"] = response.text
-            
-            # レート制限情報
-            rate_limit_info = {}
-            for header in ['X-RateLimit-Limit', 'X-RateLimit-Remaining', 'X-RateLimit-Reset']:
-                if header in response.headers:
-                    rate_limit_info[header] = response.headers[header]
-            
-            if rate_limit_info:
-                result["rate_limit"] = rate_limit_info
-            
-            # 結果の表示
-            if result["success"]:
-                print(f"   ✅ 成功: HTTP {response.status_code}")
-                if "response" in result:
-                    print(f"   データ件数: {len(result['response']) if isinstance(result['response'], list) else '1件'}")
-            else:
-                print(f"   ❌ 失敗: HTTP {response.status_code}")
-                print(f"   エラー内容: {result.get('response', result.get('response_text', 'No response'))}")
-            
-            return result
+            response = self.session.request(method.upper(), url, json=data, headers=extra_headers, timeout=30)
+            return self._summarize_response(response, description, response.ok)
             
         except requests.exceptions.RequestException as e:
-            error_result = {
-                "error": str(e),
-                "success": False,
-                "description": description,
-                "url": url
-            }
-            print(f"   ❌ 接続エラー: {e}")
-            return error_result
+            return self._error_result(e, description, url)
+    
+    @staticmethod
+    def _summarize_response(response, description: str, success: bool) -> Dict[str, Any]:
+        """レスポンスを結果 dict にまとめる（requests / httpx 共通）"""
+        result = {
+            "status_code": response.status_code,
+            "success": success,
+            "headers": dict(response.headers),
+            "url": str(response.url),
+            "description": description
+        }
+        
+        # レスポンス本文の処理
+        try:
+            result["response"] = response.json()
+        except json.JSONDecodeError:
+            result["response_text"] = response.text
+        
+        # レート制限情報
+        rate_limit_info = {}
+        for header in ['X-RateLimit-Limit', 'X-RateLimit-Remaining', 'X-RateLimit-Reset']:
+            if header in response.headers:
+                rate_limit_info[header] = response.headers[header]
+        
+        if rate_limit_info:
+            result["rate_limit"] = rate_limit_info
+        
+        return result
+    
+    @staticmethod
+    def _error_result(e: Exception, description: str, url: str) -> Dict[str, Any]:
+        """通信エラー時の結果 dict"""
+        return {
+            "error": str(e),
+            "success": False,
+            "description": description,
+            "url": url
+        }
+    
+    def _print_probe(self, method: str, url: str, description: str, result: Dict[str, Any]):
+        """_test_endpoint の結果の表示（verbose 時のみ）"""
+        if not self.verbose:
+            return
+        print(f"\n🔍 テスト中: {description}")
+        print(f"   Method: {method}")
+        print(f"   URL: {url}")
+        print(f"   Headers: {self._headers_repr}")
+        
+        if "error" in result:
+            print(f"   ❌ 接続エラー: {result['error']}")
+        elif result["success"]:
+            print(f"   ✅ 成功: HTTP {result['status_code']}")
+            if "response" in result:
+                print(f"   データ件数: {len(result['response']) if isinstance(result['response'], list) else '1件'}")
+        else:
+            print(f"   ❌ 失敗: HTTP {result['status_code']}")
+            print(f"   エラー内容: {result.get('response', result.get('response_text', 'No response'))}")
     
     def diagnose_404_causes(self) -> Dict[str, Any]:
         """404エラーの原因診断"""
+        self._print_diagnosis_header()
+        test_url = f"{self.base_url}/message_boxes"
+        
+        # URLパターンと認証パターンは互いに独立なので、まとめて並列に投げる
+        with ThreadPoolExecutor(max_workers=MAX_PARALLEL_PROBES) as executor:
+            url_futures = [
+                executor.submit(self._test_endpoint, "GET", url, f"URLパターン: {name}")
+                for name, url in self._url_patterns
+            ]
+            auth_futures = [
+                executor.submit(self._test_endpoint, "GET", test_url, f"認証ヘッダー変更パターン {i+1}", extra_headers=hv)
+                for i, hv in enumerate(self._auth_variations)
+            ]
+        
+        return self._collect_diagnoses(
+            [f.result() for f in url_futures], [f.result() for f in auth_futures]
+        )
+    
+    def _print_diagnosis_header(self):
+        """404 診断の見出しと設定値の表示"""
         print("\n" + "="*60)
         print("🔍 Re:lation API 404エラー原因診断")
         print("="*60)
         
-        diagnoses = {}
-        
         # 1. 基本的な設定値確認
         print("\n📋 設定値確認:")
         print(f"   Subdomain: {self.subdomain}")
         print(f"   Message Box ID: {self.message_box_id}")
         print(f"   Access Token: {'設定済み' if self.access_token else '未設定'}")
         print(f"   Base URL: {self.base_url}")
-        
-        # 2. 様々なURLパターンでのテスト
-        url_patterns = {
-            "v1_api": f"https://{self.subdomain}.relationapp.jp/api/v1/message_boxes",
-            "v2_api": f"https://{self.subdomain}.relationapp.jp/api/v2/message_boxes", 
-            "with_message_box": f"https://{self.subdomain}.relationapp.jp/api/v2/{self.message_box_id}/users",
-            "root_check": f"https://{self.subdomain}.relationapp.jp/",
-        }
-        
+    
+    def _collect_diagnoses(self, url_results: List[Dict[str, Any]], auth_results: List[Dict[str, Any]]) -> Dict[str, Any]:
+        """2. URLパターン / 3. 認証ヘッダーの結果を登録順に表示してまとめる"""
+        diagnoses = {}
         print("\n🌐 URLパターン検証:")
-        for pattern_name, url in url_patterns.items():
-            diagnoses[pattern_name] = self._test_endpoint("GET", url, f"URLパターン: {pattern_name}")
+        for (pattern_name, url), result in zip(self._url_patterns, url_results):
+            diagnoses[pattern_name] = result
+            self._print_probe("GET", url, f"URLパターン: {pattern_name}", result)
         
-        # 3. 認証ヘッダーのバリエーションテスト
         print("\n🔐 認証ヘッダー検証:")
-        auth_variations = [
-            {"Authorization": f"Bearer {self.access_token}"},
-            {"Authorization": f"Token {self.access_token}"},
-            {"X-API-Token": self.access_token},
-            {"Authorization": self.access_token},
-        ]
-        
-        test_url = f"{self.base_url}/message_boxes"
-        for i, headers_variant in enumerate(auth_variations):
-            test_headers = {**self.headers, **headers_variant}
-            try:
-                response = requests.get(test_url, headers=test_headers, timeout=30)
-                diagnoses[f"auth_variant_{i}"] = {
-                    "status_code": response.status_code,
-                    "success": response.status_code < 400,
-                    "headers_used": headers_variant,
-                    "description": f"認証ヘッダー変更パターン {i+1}"
-                }
-                print(f"   パターン {i+1}: HTTP {response.status_code} - {headers_variant}")
-            except Exception as e:
-                diagnoses[f"auth_variant_{i}"] = {
-                    "error": str(e),
-                    "headers_used": headers_variant,
-                    "description": f"認証ヘッダー変更パターン {i+1}"
-                }
+        for i, result in enumerate(auth_results):
+            diagnoses[f"auth_variant_{i}"] = result
+            if "status_code" in result:
+                header, tpl = self._AUTH_VARIATIONS[i]
+                print(f"   パターン {i+1}: HTTP {result['status_code']} - {{'{header}': '{tpl.format(token='***')}'}}")
         
         return diagnoses
     
     def generate_debug_report(self) -> str:
         """デバッグレポートの生成"""
-        print("\n" + "="*60)
-        print("📊 Re:lation API 詳細調査開始")
-        print("="*60)
+        self._print_report_start()
         
         # 基本接続テスト
         connectivity_results = self.test_api_connectivity()
@@ -212,96 +268,106 @@ class RelationAPIInvestigator:
         # 404エラー原因診断
         diagnostic_results = self.diagnose_404_causes()
         
-        # レポート生成
-        report_lines = []
-        report_lines.append("# Re:lation API 調査レポート")
-        report_lines.append(f"調査日時: {__import__('datetime').datetime.now().strftime('%Y-%m-%d %H:%M:%S')}")
-        report_lines.append("")
+        return self._build_report(connectivity_results, diagnostic_results)
+    
+    @staticmethod
+    def _print_report_start():
+        print("\n" + "="*60)
+        print("📊 Re:lation API 詳細調査開始")
+        print("="*60)
+    
+    def _build_report(self, connectivity_results: Dict[str, Any], diagnostic_results: Dict[str, Any]) -> str:
+        """調査結果から Markdown レポートを組み立てて表示する"""
+        buf = io.StringIO()
+        w = buf.write
+        w("# Re:lation API 調査レポート\n")
+        w(f"調査日時: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}\n")
+        w("\n")
         
         # 設定確認
-        report_lines.append("## 設定確認")
-        report_lines.append(f"- Subdomain: {self.subdomain}")
-        report_lines.append(f"- Message Box ID: {self.message_box_id}")  
-        report_lines.append(f"- Access Token: {'✅ 設定済み' if self.access_token else '❌ 未設定'}")
-        report_lines.append(f"- Base URL: {self.base_url}")
-        report_lines.append("")
+        w("## 設定確認\n")
+        w(f"- Subdomain: {self.subdomain}\n")
+        w(f"- Message Box ID: {self.message_box_id}\n")
+        w(f"- Access Token: {'✅ 設定済み' if self.access_token else '❌ 未設定'}\n")
+        w(f"- Base URL: {self.base_url}\n")
+        w("\n")
         
         # 接続テスト結果
-        report_lines.append("## API接続テスト結果")
+        w("## API接続テスト結果\n")
         for endpoint_name, result in connectivity_results.items():
             status = "✅ 成功" if result.get("success") else "❌ 失敗"
             status_code = result.get("status_code", "N/A")
-            report_lines.append(f"- {result.get('description', endpoint_name)}: {status} (HTTP {status_code})")
+            w(f"- {result.get('description', endpoint_name)}: {status} (HTTP {status_code})\n")
             
             if not result.get("success") and "response" in result:
                 error_msg = result["response"]
                 if isinstance(error_msg, dict):
                     error_msg = json.dumps(error_msg, ensure_ascii=False)
-                report_lines.append(f"  エラー詳細: {error_msg}")
+                w(f"  エラー詳細: {error_msg}\n")
         
-        report_lines.append("")
+        w("\n")
         
         # 診断結果
-        report_lines.append("## 404エラー原因診断")
+        w("## 404エラー原因診断\n")
         successful_patterns = []
         failed_patterns = []
         
         for pattern_name, result in diagnostic_results.items():
             if result.get("success"):
-                successful_patterns.append(f"- {result.get('description', pattern_name)}: ✅ HTTP {result['status_code']}")
+                successful_patterns.append(f"- {result.get('description', pattern_name)}: ✅ HTTP {result['status_code']}\n")
             else:
                 status_code = result.get("status_code", "接続エラー")
-                failed_patterns.append(f"- {result.get('description', pattern_name)}: ❌ {status_code}")
+                failed_patterns.append(f"- {result.get('description', pattern_name)}: ❌ {status_code}\n")
         
         if successful_patterns:
-            report_lines.append("### 成功したパターン")
-            report_lines.extend(successful_patterns)
-            report_lines.append("")
+            w("### 成功したパターン\n")
+            buf.writelines(successful_patterns)
+            w("\n")
         
         if failed_patterns:
-            report_lines.append("### 失敗したパターン")
-            report_lines.extend(failed_patterns)
-            report_lines.append("")
+            w("### 失敗したパターン\n")
+            buf.writelines(failed_patterns)
+            w("\n")
         
         # 推奨解決策
-        report_lines.append("## 推奨解決策")
+        w("## 推奨解決策\n")
         
         # 成功パターンがある場合
         if any(r.get("success") for r in {**connectivity_results, **diagnostic_results}.values()):
-            report_lines.append("### ✅ API接続が一部成功しています")
-            report_lines.append("1. 成功したエンドポイントのパターンを参考に実装を修正")
-            report_lines.append("2. message_box_idが必要なエンドポイントと不要なエンドポイントを確認")
-            report_lines.append("3. 正しいベースURL形式を使用")
+            w("### ✅ API接続が一部成功しています\n")
+            w("1. 成功したエンドポイントのパターンを参考に実装を修正\n")
+            w("2. message_box_idが必要なエンドポイントと不要なエンドポイントを確認\n")
+            w("3. 正しいベースURL形式を使用\n")
         else:
-            report_lines.append("### ❌ 全てのAPIコールが失敗しています")
-            report_lines.append("以下の点を確認してください:")
-            report_lines.append("1. **アクセストークンの確認**")
-            report_lines.append("   - Re:lation管理画面で「APIトークン」が正しく発行されているか")
-            report_lines.append("   - トークンの有効期限が切れていないか")
-            report_lines.append("   - トークンにメッセージボックスへのアクセス権限があるか")
-            report_lines.append("")
-            report_lines.append("2. **サブドメインの確認**")
-            report_lines.append("   - Re:lationの実際のサブドメインと環境変数の値が一致しているか")
-            report_lines.append("   - 例: https://your-company.relationapp.jp の場合、RELATION_SUBDOMAIN=your-company")
-            report_lines.append("")
-            report_lines.append("3. **メッセージボックスIDの確認**") 
-            report_lines.append("   - Re:lation管理画面でメッセージボックスの数値IDを確認")
-            report_lines.append("   - URLやAPI レスポンスから正しいIDを取得")
-            report_lines.append("")
-            report_lines.append("4. **ネットワーク設定の確認**")
-            report_lines.append("   - ファイアウォールやプロキシの設定")
-            report_lines.append("   - IP制限の設定（Re:lation側での制限）")
-        
-        report_lines.append("")
-        report_lines.append("## 実装推奨事項")
-        report_lines.append("1. **正しいベースURL**: `https://{subdomain}.relationapp.jp/api/v2`")
-        report_lines.append("2. **認証ヘッダー**: `Authorization: Bearer {access_token}`")
-        report_lines.append("3. **Content-Type**: `application/json` (POST/PUT時)")
-        report_lines.append("4. **レート制限**: 60回/分を遵守")
-        report_lines.append("5. **タイムアウト設定**: 30秒程度を推奨")
-        report_lines.append("6. **エラーハンドリング**: HTTPステータスコードに応じた適切な処理")
-        
-        report = "\n".join(report_lines)
+            w("### ❌ 全てのAPIコールが失敗しています\n")
+            w("以下の点を確認してください:\n")
+            w("1. **アクセストークンの確認**\n")
+            w("   - Re:lation管理画面で「APIトークン」が正しく発行されているか\n")
+            w("   - トークンの有効期限が切れていないか\n")
+            w("   - トークンにメッセージボックスへのアクセス権限があるか\n")
+            w("\n")
+            w("2. **サブドメインの確認**\n")
+            w("   - Re:lationの実際のサブドメインと環境変数の値が一致しているか\n")
+            w("   - 例: https://your-company.relationapp.jp の場合、RELATION_SUBDOMAIN=your-company\n")
+            w("\n")
+            w("3. **メッセージボックスIDの確認**\n")
+            w("   - Re:lation管理画面でメッセージボックスの数値IDを確認\n")
+            w("   - URLやAPI レスポンスから正しいIDを取得\n")
+            w("\n")
+            w("4. **ネットワーク設定の確認**\n")
+            w("   - ファイアウォールやプロキシの設定\n")
+            w("   - IP制限の設定（Re:lation側での制限）\n")
+        
+        w("\n")
+        w("## 実装推奨事項\n")
+        w("1. **正しいベースURL**: `https://{subdomain}.relationapp.jp/api/v2`\n")
+        w("2. **認証ヘッダー**: `Authorization: Bearer {access_token}`\n")
+        w("3. **Content-Type**: `application/json` (POST/PUT時)\n")
+        w("4. **レート制限**: 60回/分を遵守\n")
+        w("5. **タイムアウト設定**: 30秒程度を推奨\n")
+        w("6. **エラーハンドリング**: HTTPステータスコードに応じた適切な処理\n")
+        
+        report = buf.getvalue()
         print("\n" + "="*60)
         print("📋 調査完了 - 詳細レポート")
         print("="*60)
@@ -310,16 +376,106 @@ class RelationAPIInvestigator:
         return report
 
 
+class AsyncRelationAPIInvestigator(RelationAPIInvestigator):
+    """Re:lation API の調査・テスト用クラス（asyncio 版）
+    
+    各プローブを httpx.AsyncClient 上のコルーチンとして asyncio.gather で同時に投げる。
+    スレッドプールを使わず、HTTP/2 が使えれば1本の接続に多重化される。
+    """
+    
+    def __init__(self, verbose: bool = False):
+        super().__init__(verbose)
+        # AsyncClient はイベントループに紐づくので、実行時に _get_client で作る
+        self._client: Optional[httpx.AsyncClient] = None
+    
+    def _create_session(self) -> None:
+        # 同期版の requests.Session は使わない
+        return None
+    
+    def _get_client(self) -> httpx.AsyncClient:
+        if self._client is None:
+            # requests と同じくリダイレクトを追い、最終的なステータスで判定する
+            self._client = httpx.AsyncClient(
+                headers=self.headers, timeout=30, http2=True, follow_redirects=True
+            )
+        return self._client
+    
+    async def aclose(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+    
+    async def test_api_connectivity(self) -> Dict[str, Any]:
+        """API接続テスト - 最も基本的なエンドポイントをテスト"""
+        probes = self._connectivity_probes()
+        results = await asyncio.gather(*[
+            self._test_endpoint(method, url, description)
+            for _, method, url, description in probes
+        ])
+        
+        for (_, method, url, description), result in zip(probes, results):
+            self._print_probe(method, url, description, result)
+        return {key: result for (key, _, _, _), result in zip(probes, results)}
+    
+    async def _test_endpoint(
+        self,
+        method: str,
+        url: str,
+        description: str,
+        data: Optional[Dict] = None,
+        extra_headers: Optional[Dict[str, str]] = None
+    ) -> Dict[str, Any]:
+        """個別エンドポイントのテスト（表示は行わず結果だけを返す）"""
+        try:
+            if method.upper() not in ("GET", "POST", "PUT"):
+                return {"error": f"未対応のHTTPメソッド: {method}"}
+            response = await self._get_client().request(method.upper(), url, json=data, headers=extra_headers)
+            return self._summarize_response(response, description, not response.is_error)
+            
+        except httpx.HTTPError as e:
+            return self._error_result(e, description, url)
+    
+    async def diagnose_404_causes(self) -> Dict[str, Any]:
+        """404エラーの原因診断"""
+        self._print_diagnosis_header()
+        test_url = f"{self.base_url}/message_boxes"
+        
+        n_urls = len(self._url_patterns)
+        results = await asyncio.gather(
+            *[self._test_endpoint("GET", url, f"URLパターン: {name}") for name, url in self._url_patterns],
+            *[
+                self._test_endpoint("GET", test_url, f"認証ヘッダー変更パターン {i+1}", extra_headers=hv)
+                for i, hv in enumerate(self._auth_variations)
+            ],
+        )
+        return self._collect_diagnoses(list(results[:n_urls]), list(results[n_urls:]))
+    
+    async def generate_debug_report_async(self) -> str:
+        """デバッグレポートの生成"""
+        self._print_report_start()
+        try:
+            # 表示順が崩れないよう段階ごとに待つ（各段階の中は同時実行）
+            connectivity_results = await self.test_api_connectivity()
+            diagnostic_results = await self.diagnose_404_causes()
+        finally:
+            await self.aclose()
+        
+        return self._build_report(connectivity_results, diagnostic_results)
+    
+    def generate_debug_report(self) -> str:
+        """同期呼び出し用の入口"""
+        return asyncio.run(self.generate_debug_report_async())
+
+
 def main():
     """メイン実行関数"""
     try:
-        investigator = RelationAPIInvestigator()
+        investigator = AsyncRelationAPIInvestigator(verbose=True)
         report = investigator.generate_debug_report()
         
         # レポートをファイルに保存
         report_file = "/Users/okunoren/Downloads/LINE/line-bot/relation_api_debug_report.md"
-        with open(report_file, "w", encoding="utf-8") as f:
-            f.write(report)
+        Path(report_file).write_text(report, encoding="utf-8")
         
         print(f"\n📄 詳細レポートを保存しました: {report_file}")
         
@@ -332,7 +488,6 @@ def main():
     
     except Exception as e:
         print(f"❌ 予期しないエラーが発生しました: {e}")
-        import traceback
         traceback.print_exc()
 
 
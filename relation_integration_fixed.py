@@ -6,10 +6,22 @@ Re:lation API 正しい統合実装
 
 import os
 import json
+import time
 import logging
-from typing import Dict, List, Optional, Any
+import threading
+from typing import ClassVar, Dict, Iterator, List, Optional, Any
 from datetime import datetime
-import requests
+from concurrent.futures import ThreadPoolExecutor
+from email.utils import parsedate_to_datetime
+import httpx
+try:
+    from orjson import loads as json_loads  # 任意: 高速な JSON パーサ（bytes をそのまま読む）
+except ImportError:
+    json_loads = json.loads
+try:
+    import ijson  # 任意: 大きな JSON 配列を逐次パースする
+except ImportError:
+    ijson = None
 from dataclasses import dataclass
 from enum import Enum
 
@@ -18,6 +30,9 @@ from enum import Enum
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# _body_json で「まだパースしていない」を表す番兵（None は「JSON 本文なし」の意味で使う）
+_UNPARSED = object()
+
 
 class RelationAPIError(Exception):
     """Re:lation API エラー"""
@@ -31,7 +46,7 @@ class TicketStatus(Enum):
     PENDING = "pending"
 
 
-@dataclass
+@dataclass(slots=True, frozen=True)
 class RelationConfig:
     """Re:lation API 設定"""
     access_token: str
@@ -41,7 +56,7 @@ class RelationConfig:
     max_retries: int = 3
 
 
-@dataclass
+@dataclass(slots=True, frozen=True)
 class TicketInfo:
     """チケット情報"""
     id: str
@@ -52,29 +67,135 @@ class TicketInfo:
     labels: Optional[List[str]] = None
     created_at: Optional[str] = None
     updated_at: Optional[str] = None
+    
+    @classmethod
+    def from_dict(cls, ticket_data: Dict[str, Any]) -> "TicketInfo":
+        """API レスポンスの dict から生成"""
+        return cls(
+            id=ticket_data.get("id"),
+            subject=ticket_data.get("subject"),
+            status=ticket_data.get("status"),
+            assignee_id=ticket_data.get("assignee_id"),
+            case_category_id=ticket_data.get("case_category_id"),
+            labels=ticket_data.get("labels", []),
+            created_at=ticket_data.get("created_at"),
+            updated_at=ticket_data.get("updated_at")
+        )
 
 
 class RelationAPIClient:
     """Re:lation API クライアント（修正版）"""
     
+    # 受信箱・ユーザー・分類・ラベルはほとんど変わらないので一定時間使い回す
+    META_CACHE_TTL = 300
+    # health_check の結果を使い回す秒数
+    HEALTH_CHECK_TTL = 30
+    
+    # HTTP ステータスごとのエラーメッセージ（呼び出しのたびに作らない）
+    _STATUS_MESSAGES: ClassVar[Dict[int, str]] = {
+        400: "リクエストパラメータが無効です",
+        401: "認証に失敗しました。アクセストークンを確認してください",
+        403: "アクセス権限がありません。またはレート制限を超過しました",
+        404: "指定されたリソースが見つかりません",
+        415: "サポートされていない形式です",
+        500: "サーバー内部エラーが発生しました",
+        503: "サービスがメンテナンス中です"
+    }
+    
+    # 一時的な失敗とみなして再試行するステータス（5xx は冪等なメソッドのみ）
+    _RETRY_STATUSES: ClassVar[frozenset] = frozenset({429, 500, 502, 503, 504})
+    # 再送してもサーバー側の状態が変わらないメソッド
+    _IDEMPOTENT_METHODS: ClassVar[frozenset] = frozenset({"GET", "HEAD"})
+    RETRY_BACKOFF = 0.5
+    # Retry-After の待ち時間の上限（秒）。Webhook 処理のスレッドを長く止めない
+    RETRY_AFTER_MAX = 10.0
+    
     def __init__(self, config: RelationConfig):
         self.config = config
         self.base_url = f"https://{config.subdomain}.relationapp.jp/api/v2"
         self.session = self._create_session()
+        # {(endpoint, message_box_id): (expires, etag, last_modified, value)}
+        self._meta_cache: Dict[tuple, tuple] = {}
+        # 同じキーの取得が並行したときは先行する1件だけが通信し、残りはその完了を待つ
+        self._inflight: Dict[tuple, threading.Event] = {}
+        self._inflight_lock = threading.Lock()
+        self._health: Optional[tuple] = None  # (expires, ok)
         
         # 設定検証
         self._validate_config()
     
-    def _create_session(self) -> requests.Session:
-        """HTTPセッションの作成"""
-        session = requests.Session()
-        session.headers.update({
-            "Authorization": f"Bearer {self.config.access_token}",
-            "Content-Type": "application/json",
-            "Accept": "application/json",
-            "User-Agent": "Re:lation-LINE-Bot-Integration/1.0"
-        })
-        return session
+    def _create_session(self) -> httpx.Client:
+        """HTTPセッションの作成（HTTP/2 で並列リクエストを1本の接続に多重化する）"""
+        return httpx.Client(
+            base_url=self.base_url,
+            headers={
+                "Authorization": f"Bearer {self.config.access_token}",
+                "Content-Type": "application/json",
+                "Accept": "application/json",
+                "User-Agent": "Re:lation-LINE-Bot-Integration/1.0"
+            },
+            http2=True,
+            timeout=self.config.timeout,
+            limits=httpx.Limits(max_keepalive_connections=10, max_connections=10)
+        )
+    
+    def _retry_delay(self, attempt: int, response: Optional[httpx.Response] = None) -> float:
+        """再試行までの待ち時間（Retry-After があればそれを優先、なければ指数バックオフ）"""
+        retry_after = response.headers.get("Retry-After") if response is not None else None
+        if retry_after:
+            try:
+                delay = float(retry_after)
+            except ValueError:
+                try:
+                    delay = parsedate_to_datetime(retry_after).timestamp() - time.time()
+                except (TypeError, ValueError):
+                    delay = None
+            if delay is not None:
+                return min(max(0.0, delay), self.RETRY_AFTER_MAX)
+        return self.RETRY_BACKOFF * (2 ** attempt)
+    
+    def _send(
+        self,
+        method: str,
+        path: str,
+        data: Optional[Dict] = None,
+        params: Optional[Dict] = None,
+        headers: Optional[Dict] = None,
+        stream: bool = False
+    ) -> httpx.Response:
+        """リクエスト送信。失敗時は config.max_retries 回まで再試行する
+        
+        GET / HEAD は 429 / 5xx / 通信エラーで再試行する。POST などは処理済みのリクエストを
+        二重に送らないよう、サーバーに届いていないことが確実な 429 と接続失敗に限る。
+        stream=True のときは本文を読まずに返すので、呼び出し側で close() すること。
+        """
+        idempotent = method.upper() in self._IDEMPOTENT_METHODS
+        for attempt in range(self.config.max_retries + 1):
+            last = attempt == self.config.max_retries
+            try:
+                request = self.session.build_request(method, path, json=data, params=params, headers=headers)
+                response = self.session.send(request, stream=stream)
+            except (httpx.ConnectError, httpx.ConnectTimeout):
+                if last:
+                    raise
+                time.sleep(self._retry_delay(attempt))
+                continue
+            except httpx.TransportError:
+                # 読み取りタイムアウト等はサーバー側で処理済みの可能性がある
+                if last or not idempotent:
+                    raise
+                time.sleep(self._retry_delay(attempt))
+                continue
+            
+            # 再試行を使い切ったら最後のレスポンスを _handle_error_response に渡す
+            retryable = response.status_code == 429 or (
+                idempotent and response.status_code in self._RETRY_STATUSES
+            )
+            if not retryable or last:
+                return response
+            logger.warning(f"HTTP {response.status_code} のため再試行します ({attempt + 1}/{self.config.max_retries})")
+            response.close()
+            time.sleep(self._retry_delay(attempt, response))
     
     def _validate_config(self):
         """設定値の検証"""
@@ -93,53 +214,62 @@ class RelationAPIClient:
         except ValueError:
             raise RelationAPIError("メッセージボックスIDは数値である必要があります")
     
+    def _path(self, endpoint: str, require_message_box: bool) -> str:
+        """エンドポイントパス構築（base_url からの相対）"""
+        if require_message_box:
+            return f"/{self.config.message_box_id}{endpoint}"
+        return endpoint
+    
     def _make_request(
         self, 
         method: str, 
         endpoint: str, 
         data: Optional[Dict] = None,
-        require_message_box: bool = True
-    ) -> requests.Response:
-        """API リクエストの実行"""
+        require_message_box: bool = True,
+        params: Optional[Dict] = None,
+        headers: Optional[Dict] = None,
+        stream: bool = False
+    ) -> httpx.Response:
+        """API リクエストの実行（stream=True なら本文未読のレスポンスを返す）"""
         
-        # エンドポイントURL構築
-        if require_message_box:
-            url = f"{self.base_url}/{self.config.message_box_id}{endpoint}"
-        else:
-            url = f"{self.base_url}{endpoint}"
+        path = self._path(endpoint, require_message_box)
+        
+        method = method.upper()
+        if method not in ("GET", "POST", "PUT", "DELETE"):
+            raise RelationAPIError(f"未対応のHTTPメソッド: {method}")
         
-        logger.info(f"API Request: {method} {url}")
+        logger.info(f"API Request: {method} {self.base_url}{path}")
         
         try:
-            if method.upper() == "GET":
-                response = self.session.get(url, timeout=self.config.timeout)
-            elif method.upper() == "POST":
-                response = self.session.post(url, json=data, timeout=self.config.timeout)
-            elif method.upper() == "PUT":
-                response = self.session.put(url, json=data, timeout=self.config.timeout)
-            elif method.upper() == "DELETE":
-                response = self.session.delete(url, timeout=self.config.timeout)
-            else:
-                raise RelationAPIError(f"未対応のHTTPメソッド: {method}")
+            response = self._send(method, path, data, params, headers, stream)
+            
+            # エラー時はストリームでも本文を読み切ってから処理する
+            if stream and response.is_error:
+                response.read()
+                response.close()
             
             # レート制限チェック
             self._check_rate_limit(response)
             
-            # エラーレスポンスの処理
-            if not response.ok:
+            # エラーレスポンスの処理（304 Not Modified は条件付き GET の正常応答として通す）
+            if response.is_error:
                 self._handle_error_response(response)
             
-            logger.info(f"API Response: {response.status_code}")
+            logger.info(f"API Response: {response.status_code} ({response.http_version})")
             return response
             
-        except requests.exceptions.Timeout:
+        # 通信に失敗したら health_check のキャッシュも捨てて次回は確認し直す
+        except httpx.TimeoutException:
+            self._health = None
             raise RelationAPIError("APIリクエストがタイムアウトしました")
-        except requests.exceptions.ConnectionError:
+        except httpx.ConnectError:
+            self._health = None
             raise RelationAPIError("API サーバーに接続できません")
-        except requests.exceptions.RequestException as e:
+        except httpx.HTTPError as e:
+            self._health = None
             raise RelationAPIError(f"API リクエストエラー: {str(e)}")
     
-    def _check_rate_limit(self, response: requests.Response):
+    def _check_rate_limit(self, response: httpx.Response):
         """レート制限チェック"""
         remaining = response.headers.get("X-RateLimit-Remaining")
         if remaining is not None and int(remaining) < 5:
@@ -149,48 +279,112 @@ class RelationAPIClient:
             reset_time = response.headers.get("X-RateLimit-Reset", "不明")
             raise RelationAPIError(f"レート制限を超過しました。リセット時刻: {reset_time}")
     
-    def _handle_error_response(self, response: requests.Response):
+    @staticmethod
+    def _body_json(response: httpx.Response) -> Any:
+        """レスポンス本文の JSON を一度だけパースして response に保持する（JSON でなければ None）"""
+        parsed = getattr(response, "_parsed", _UNPARSED)
+        if parsed is _UNPARSED:
+            body = response.content.lstrip()
+            parsed = json_loads(response.content) if body[:1] in (b"{", b"[") else None
+            response._parsed = parsed
+        return parsed
+    
+    def _handle_error_response(self, response: httpx.Response):
         """エラーレスポンスの処理"""
+        self._health = None
         try:
-            error_data = response.json()
-            error_message = error_data.get("message", "不明なエラー")
+            error_data = self._body_json(response)
         except json.JSONDecodeError:
+            error_data = None
+        if isinstance(error_data, dict):
+            error_message = error_data.get("message", "不明なエラー")
+        else:
             error_message = response.text or "エラー詳細なし"
         
-        status_messages = {
-            400: "リクエストパラメータが無効です",
-            401: "認証に失敗しました。アクセストークンを確認してください",
-            403: "アクセス権限がありません。またはレート制限を超過しました",
-            404: "指定されたリソースが見つかりません",
-            415: "サポートされていない形式です",
-            500: "サーバー内部エラーが発生しました",
-            503: "サービスがメンテナンス中です"
-        }
-        
-        base_message = status_messages.get(response.status_code, "API エラーが発生しました")
+        base_message = self._STATUS_MESSAGES.get(response.status_code, "API エラーが発生しました")
         raise RelationAPIError(f"{base_message} (HTTP {response.status_code}): {error_message}")
     
+    # ========== メタデータキャッシュ ==========
+    
+    def _cached_get(self, endpoint: str, require_message_box: bool = True) -> Any:
+        """変化の少ない参照系 GET を TTL 付きでキャッシュする
+        
+        TTL 切れの再取得は ETag / Last-Modified による条件付き GET で行い、
+        304 なら本文を受け取らずに手元の値をそのまま使い続ける。
+        """
+        key = (endpoint, self.config.message_box_id if require_message_box else None)
+        while True:
+            hit = self._meta_cache.get(key)
+            if hit is not None and hit[0] > time.monotonic():
+                return hit[3]
+            
+            with self._inflight_lock:
+                event = self._inflight.get(key)
+                leader = event is None
+                if leader:
+                    event = self._inflight[key] = threading.Event()
+            
+            if not leader:
+                # 先行リクエストの完了後にキャッシュを見直す（失敗していたら自分で取りに行く）
+                event.wait()
+                continue
+            
+            try:
+                return self._fetch_meta(key, endpoint, require_message_box, hit)
+            finally:
+                with self._inflight_lock:
+                    del self._inflight[key]
+                event.set()
+    
+    def _fetch_meta(self, key: tuple, endpoint: str, require_message_box: bool, hit: Optional[tuple]) -> Any:
+        """メタデータの取得とキャッシュ格納（hit があれば条件付き GET）"""
+        now = time.monotonic()
+        headers = {}
+        if hit is not None:
+            _, etag, last_modified, _ = hit
+            if etag:
+                headers["If-None-Match"] = etag
+            if last_modified:
+                headers["If-Modified-Since"] = last_modified
+        
+        response = self._make_request(
+            "GET", endpoint, require_message_box=require_message_box, headers=headers or None
+        )
+        if response.status_code == 304 and hit is not None:
+            value = hit[3]
+            etag, last_modified = hit[1], hit[2]
+        else:
+            value = self._body_json(response)
+            etag = response.headers.get("ETag")
+            last_modified = response.headers.get("Last-Modified")
+        self._meta_cache[key] = (now + self.META_CACHE_TTL, etag, last_modified, value)
+        return value
+    
+    def invalidate_cache(self, endpoint: Optional[str] = None):
+        """メタデータキャッシュの破棄（endpoint 指定時はそのエンドポイントのみ）"""
+        if endpoint is None:
+            self._meta_cache.clear()
+            return
+        for key in [k for k in self._meta_cache if k[0] == endpoint]:
+            del self._meta_cache[key]
+    
     # ========== 基本的なAPI メソッド ==========
     
     def get_message_boxes(self) -> List[Dict[str, Any]]:
         """受信箱一覧の取得"""
-        response = self._make_request("GET", "/message_boxes", require_message_box=False)
-        return response.json()
+        return self._cached_get("/message_boxes", require_message_box=False)
     
     def get_users(self) -> List[Dict[str, Any]]:
         """ユーザー一覧の取得"""
-        response = self._make_request("GET", "/users")
-        return response.json()
+        return self._cached_get("/users")
     
     def get_case_categories(self) -> List[Dict[str, Any]]:
         """チケット分類一覧の取得"""
-        response = self._make_request("GET", "/case_categories")
-        return response.json()
+        return self._cached_get("/case_categories")
     
     def get_labels(self) -> List[Dict[str, Any]]:
         """ラベル一覧の取得"""
-        response = self._make_request("GET", "/labels")
-        return response.json()
+        return self._cached_get("/labels")
     
     def search_tickets(
         self, 
@@ -200,6 +394,55 @@ class RelationAPIClient:
         limit: int = 10
     ) -> List[Dict[str, Any]]:
         """チケット検索"""
+        params = self._search_params(query, status, assignee_id, limit)
+        
+        # クエリ文字列のエンコードは httpx に任せる（& や空白、日本語を含む query も安全）
+        response = self._make_request("GET", "/tickets/search", params=params)
+        return self._body_json(response)
+    
+    def iter_tickets(
+        self, 
+        query: Optional[str] = None,
+        status: Optional[str] = None,
+        assignee_id: Optional[str] = None,
+        limit: int = 10
+    ) -> Iterator[TicketInfo]:
+        """チケット検索（結果を受信しながら1件ずつ返す）
+        
+        ijson があればレスポンス全体をメモリに載せずに配列要素を逐次パースする。
+        途中で反復をやめれば残りの本文は読まずに接続を閉じる。
+        """
+        if ijson is None:
+            for ticket in self.search_tickets(query, status, assignee_id, limit):
+                yield TicketInfo.from_dict(ticket)
+            return
+        
+        params = self._search_params(query, status, assignee_id, limit)
+        response = self._make_request("GET", "/tickets/search", params=params, stream=True)
+        try:
+            items = ijson.sendable_list()
+            parser = ijson.items_coro(items, "item", use_float=True)  # 数値は json と同じく float で受け取る
+            for chunk in response.iter_bytes():
+                parser.send(chunk)
+                for ticket in items:
+                    yield TicketInfo.from_dict(ticket)
+                del items[:]
+            parser.close()
+            for ticket in items:
+                yield TicketInfo.from_dict(ticket)
+        except httpx.HTTPError as e:
+            raise RelationAPIError(f"API リクエストエラー: {str(e)}")
+        finally:
+            response.close()
+    
+    @staticmethod
+    def _search_params(
+        query: Optional[str],
+        status: Optional[str],
+        assignee_id: Optional[str],
+        limit: int
+    ) -> Dict[str, Any]:
+        """/tickets/search のクエリパラメータ"""
         params = {"limit": limit}
         if query:
             params["query"] = query
@@ -207,18 +450,12 @@ class RelationAPIClient:
             params["status"] = status
         if assignee_id:
             params["assignee_id"] = assignee_id
-        
-        # パラメータをクエリ文字列に変換
-        query_string = "&".join([f"{k}={v}" for k, v in params.items()])
-        endpoint = f"/tickets/search?{query_string}"
-        
-        response = self._make_request("GET", endpoint)
-        return response.json()
+        return params
     
     def get_ticket(self, ticket_id: str) -> Dict[str, Any]:
         """特定チケットの詳細取得"""
         response = self._make_request("GET", f"/tickets/{ticket_id}")
-        return response.json()
+        return self._body_json(response)
     
     def update_ticket(
         self, 
@@ -240,7 +477,9 @@ class RelationAPIClient:
             data["label_ids"] = label_ids
         
         response = self._make_request("PUT", f"/tickets/{ticket_id}", data)
-        return response.json()
+        # ラベル等を付け替えた直後に古い一覧を返さないよう破棄しておく
+        self.invalidate_cache()
+        return self._body_json(response)
     
     def create_comment(
         self, 
@@ -255,13 +494,14 @@ class RelationAPIClient:
             "is_private": is_private
         }
         response = self._make_request("POST", "/comments", data)
-        return response.json()
+        self.invalidate_cache()
+        return self._body_json(response)
     
     def search_templates(self, query: str) -> List[Dict[str, Any]]:
         """テンプレート検索（2024年4月追加）"""
         data = {"query": query}
         response = self._make_request("POST", "/templates/search", data)
-        return response.json()
+        return self._body_json(response)
     
     # ========== 高レベルな統合メソッド ==========
     
@@ -292,34 +532,40 @@ class RelationAPIClient:
         # チケット作成（実際のエンドポイントは仕様書で確認必要）
         try:
             response = self._make_request("POST", "/tickets", ticket_data)
-            return response.json()
+            return self._body_json(response)
         except RelationAPIError as e:
             logger.error(f"チケット作成に失敗: {e}")
             raise
     
     def get_ticket_summary(self, ticket_id: str) -> TicketInfo:
         """チケットサマリー取得"""
-        ticket_data = self.get_ticket(ticket_id)
-        
-        return TicketInfo(
-            id=ticket_data.get("id"),
-            subject=ticket_data.get("subject"),
-            status=ticket_data.get("status"),
-            assignee_id=ticket_data.get("assignee_id"),
-            case_category_id=ticket_data.get("case_category_id"),
-            labels=ticket_data.get("labels", []),
-            created_at=ticket_data.get("created_at"),
-            updated_at=ticket_data.get("updated_at")
-        )
+        return TicketInfo.from_dict(self.get_ticket(ticket_id))
     
-    def health_check(self) -> bool:
-        """API 接続確認"""
+    def head_request(self, endpoint: str, require_message_box: bool = False) -> bool:
+        """HEAD リクエストで到達確認（本文は受け取らない）"""
         try:
-            # 最もシンプルなエンドポイントで接続確認
-            self.get_message_boxes()
-            return True
-        except RelationAPIError:
+            response = self.session.head(self._path(endpoint, require_message_box))
+        except httpx.HTTPError:
             return False
+        if response.status_code == 405:
+            # HEAD 非対応なら通常の GET（メタデータキャッシュ経由）で確認する
+            try:
+                self._cached_get(endpoint, require_message_box)
+                return True
+            except RelationAPIError:
+                return False
+        return not response.is_error
+    
+    def health_check(self) -> bool:
+        """API 接続確認（結果は HEALTH_CHECK_TTL 秒キャッシュ）"""
+        now = time.monotonic()
+        if self._health is not None and self._health[0] > now:
+            return self._health[1]
+        
+        # 最もシンプルなエンドポイントで接続確認
+        ok = self.head_request("/message_boxes", require_message_box=False)
+        self._health = (now + self.HEALTH_CHECK_TTL, ok)
+        return ok
 
 
 class RelationService:
@@ -327,7 +573,6 @@ class RelationService:
     
     def __init__(self, config: RelationConfig):
         self.client = RelationAPIClient(config)
-        self._cache = {}  # 簡易キャッシュ
     
     def process_line_message(
         self, 
@@ -373,13 +618,34 @@ class RelationService:
                 limit=limit
             )
             
-            return [
-                self.client.get_ticket_summary(ticket["id"]) 
-                for ticket in tickets
-            ]
+            if not tickets:
+                return []
+            
+            # 検索結果に詳細が含まれていれば追加のリクエストは不要
+            if all("subject" in t and "status" in t for t in tickets):
+                return [TicketInfo.from_dict(t) for t in tickets]
+            
+            # ID だけのスタブが返ってきた場合は詳細取得を並列に行う（N 回直列の往復を避ける）
+            with ThreadPoolExecutor(max_workers=min(8, len(tickets))) as ex:
+                return list(ex.map(self.client.get_ticket_summary, [t["id"] for t in tickets]))
         except RelationAPIError as e:
             logger.error(f"チケット取得失敗: {e}")
             return []
+    
+    def iter_user_tickets(
+        self, 
+        user_id: str, 
+        limit: int = 5
+    ) -> Iterator[TicketInfo]:
+        """ユーザーのチケットを受信順に1件ずつ返す（先頭の数件だけ必要な呼び出し向け）"""
+        try:
+            for ticket in self.client.iter_tickets(query=user_id, limit=limit):
+                if ticket.subject is None or ticket.status is None:
+                    # ID だけのスタブは詳細を取り直す
+                    ticket = self.client.get_ticket_summary(ticket.id)
+                yield ticket
+        except RelationAPIError as e:
+            logger.error(f"チケット取得失敗: {e}")
 
 
 def create_relation_service_from_env() -> RelationService:
@@ -4,12 +4,20 @@ LINE Bot と Re:lation API の統合テスト
 """
 import os
 import json
-import requests
+import asyncio
+import logging
+import contextvars
+import httpx
 from datetime import datetime
-from dotenv import load_dotenv
-
-# 環境変数の読み込み
-load_dotenv()
+from config import CONFIG
+try:
+    from orjson import loads as json_loads  # 任意: 高速な JSON パーサ
+except ImportError:
+    json_loads = json.loads
+try:
+    import pytest  # 任意: pytest + pytest-asyncio で実行する場合のみ必要
+except ImportError:
+    pytest = None
 
 # テストカラー
 GREEN = '\033[92m'
@@ -18,24 +26,67 @@ YELLOW = '\033[93m'
 BLUE = '\033[94m'
 ENDC = '\033[0m'
 
+# print_test の結果表示（False / True で引く）
+_STATUS = (f"{RED}❌ 失敗{ENDC}", f"{GREEN}✅ 成功{ENDC}")
+
+# 各テストに必要な環境変数（.env は config の import 時に os.environ へ読み込み済み）
+REQUIRED_RELATION = frozenset({"RELATION_ACCESS_TOKEN", "RELATION_SUBDOMAIN", "RELATION_MESSAGE_BOX_ID"})
+REQUIRED_SUPABASE = frozenset({"SUPABASE_URL", "SUPABASE_KEY"})
+
+def missing_env(required):
+    """required のうち未設定（空文字を含む）の環境変数名を返す"""
+    return {k for k in required if not os.environ.get(k)}
+
+# 並行実行中のテストの出力先（テストごとにバッファし、終了後に登録順で表示する）
+_output = contextvars.ContextVar("output", default=None)
+
+def emit(line=""):
+    """1行出力（テスト実行中ならそのテストのバッファへ）"""
+    buf = _output.get()
+    if buf is None:
+        print(line)
+    else:
+        buf.append(line)
+
+# テスト結果は logger に流す（INFO: 成功 / ERROR: 失敗）。メッセージは "テスト名: 詳細"
+logger = logging.getLogger("itest")
+
+class ColorFormatter(logging.Formatter):
+    """テスト結果のレコードを色付きの表示に整形する"""
+    def format(self, record):
+        name, details = record.args
+        text = f"\n{BLUE}[テスト]{ENDC} {name}\n  結果: {_STATUS[record.levelno <= logging.INFO]}"
+        if details:
+            text += f"\n  詳細: {details}"
+        return text
+
+class EmitHandler(logging.Handler):
+    """モジュールの emit() に書き出すハンドラ（並行実行中はテストごとのバッファへ）"""
+    def emit(self, record):
+        emit(self.format(record))
+
+def setup_logging(level=logging.INFO):
+    """スクリプト実行時の出力設定（pytest 実行時は root ロガーに任せる）"""
+    handler = EmitHandler()
+    handler.setFormatter(ColorFormatter())
+    logger.addHandler(handler)
+    logger.setLevel(level)
+    logger.propagate = False
+
 def print_test(name, result, details=""):
     """テスト結果を表示"""
-    status = f"{GREEN}✅ 成功{ENDC}" if result else f"{RED}❌ 失敗{ENDC}"
-    print(f"\n{BLUE}[テスト]{ENDC} {name}")
-    print(f"  結果: {status}")
-    if details:
-        print(f"  詳細: {details}")
+    logger.log(logging.INFO if result else logging.ERROR, "%s: %s", name, details)
 
-def test_relation_api():
+async def check_relation_api(client):
     """Re:lation API接続テスト"""
-    print(f"\n{YELLOW}=== Re:lation API テスト ==={ENDC}")
+    emit(f"\n{YELLOW}=== Re:lation API テスト ==={ENDC}")
     
-    token = os.getenv('RELATION_ACCESS_TOKEN')
-    subdomain = os.getenv('RELATION_SUBDOMAIN')
-    message_box_id = os.getenv('RELATION_MESSAGE_BOX_ID')
+    token = CONFIG.relation_token
+    subdomain = CONFIG.relation_subdomain
+    message_box_id = CONFIG.relation_message_box_id
     
-    if not all([token, subdomain, message_box_id]):
-        print_test("環境変数チェック", False, "必要な環境変数が設定されていません")
+    if missing := missing_env(REQUIRED_RELATION):
+        print_test("環境変数チェック", False, f"未設定: {', '.join(sorted(missing))}")
         return False
     
     # 受信箱一覧の取得
@@ -46,9 +97,9 @@ def test_relation_api():
     }
     
     try:
-        response = requests.get(url, headers=headers, timeout=10)
+        response = await client.get(url, headers=headers, timeout=10)
         if response.status_code == 200:
-            data = response.json()
+            data = json_loads(response.content)
             print_test("Re:lation API接続", True, f"受信箱数: {len(data)}")
             
             # メッセージボックスIDの確認
@@ -65,13 +116,13 @@ def test_relation_api():
         print_test("Re:lation API接続", False, str(e))
         return False
 
-def test_line_webhook():
+async def check_line_webhook(client):
     """LINE Webhookエンドポイントテスト"""
-    print(f"\n{YELLOW}=== LINE Webhook テスト ==={ENDC}")
+    emit(f"\n{YELLOW}=== LINE Webhook テスト ==={ENDC}")
     
     # ヘルスチェック
     try:
-        response = requests.get("http://localhost:8001/health", timeout=5)
+        response = await client.get("http://localhost:8001/health", timeout=5)
         if response.status_code == 200:
             print_test("サーバーヘルスチェック", True, "サーバーは正常に稼働中")
         else:
@@ -83,7 +134,7 @@ def test_line_webhook():
     
     # LINE Webhookエンドポイントの確認（GETリクエスト）
     try:
-        response = requests.get("http://localhost:8001/line", timeout=5)
+        response = await client.get("http://localhost:8001/line", timeout=5)
         # LINE webhookは通常POSTのみ受け付けるため、405が正常
         if response.status_code == 405:
             print_test("LINE Webhookエンドポイント", True, "エンドポイントが存在します")
@@ -95,26 +146,26 @@ def test_line_webhook():
         print_test("LINE Webhookエンドポイント", False, str(e))
         return False
 
-def test_ai_response():
+async def check_ai_response(client):
     """AI応答機能のテスト"""
-    print(f"\n{YELLOW}=== AI応答機能テスト ==={ENDC}")
+    emit(f"\n{YELLOW}=== AI応答機能テスト ==={ENDC}")
     
     # テスト用の質問
     test_query = "製品の返品方法を教えてください"
     
     try:
-        response = requests.post(
+        response = await client.post(
             "http://localhost:8001/test-ai",
             json={"query": test_query},
             timeout=30
         )
         
         if response.status_code == 200:
-            data = response.json()
+            data = json_loads(response.content)
             if "response" in data:
                 print_test("AI応答生成", True, f"回答文字数: {len(data['response'])}")
-                print(f"  {BLUE}質問:{ENDC} {test_query}")
-                print(f"  {BLUE}回答:{ENDC} {data['response'][:100]}...")
+                emit(f"  {BLUE}質問:{ENDC} {test_query}")
+                emit(f"  {BLUE}回答:{ENDC} {data['response'][:100]}...")
                 return True
             else:
                 print_test("AI応答生成", False, "レスポンスが不正です")
@@ -129,15 +180,15 @@ def test_ai_response():
         print_test("AI応答生成", False, str(e))
         return False
 
-def test_database_connection():
+async def check_database_connection(client):
     """データベース接続テスト"""
-    print(f"\n{YELLOW}=== データベース接続テスト ==={ENDC}")
+    emit(f"\n{YELLOW}=== データベース接続テスト ==={ENDC}")
     
-    supabase_url = os.getenv('SUPABASE_URL')
-    supabase_key = os.getenv('SUPABASE_KEY')
+    supabase_url = CONFIG.supabase_url
+    supabase_key = CONFIG.supabase_key
     
-    if not all([supabase_url, supabase_key]):
-        print_test("Supabase環境変数", False, "必要な環境変数が設定されていません")
+    if missing := missing_env(REQUIRED_SUPABASE):
+        print_test("Supabase環境変数", False, f"未設定: {', '.join(sorted(missing))}")
         return False
     
     print_test("Supabase環境変数", True, "設定確認済み")
@@ -149,14 +200,15 @@ def test_database_connection():
     }
     
     try:
-        # FAQテーブルの存在確認
-        response = requests.get(
-            f"{supabase_url}/rest/v1/faq_embeddings?select=count",
+        # FAQテーブルの存在確認（HEAD + limit=0 なので行の走査も本文の転送もしない）
+        response = await client.head(
+            f"{supabase_url}/rest/v1/faq_embeddings",
+            params={"limit": 0},
             headers=headers,
             timeout=10
         )
         
-        if response.status_code == 200:
+        if response.status_code in (200, 206):
             print_test("Supabaseデータベース接続", True, "FAQ埋め込みテーブルにアクセス可能")
             return True
         elif response.status_code == 401:
@@ -169,19 +221,99 @@ def test_database_connection():
         print_test("Supabaseデータベース接続", False, str(e))
         return False
 
-def main():
+def make_client():
+    """全チェックで共有する HTTP クライアント"""
+    # 接続はホストごとにプールされ、localhost:8001 への複数リクエストも keep-alive で使い回される
+    limits = httpx.Limits(max_connections=8, max_keepalive_connections=4)
+    # HTTP/2 対応のホスト（Supabase / relationapp.jp）は1本の接続にリクエストを多重化する
+    return httpx.AsyncClient(http2=True, limits=limits)
+
+async def warm_up(client):
+    """localhost:8001 への接続を先に張っておく（以降の /health・/line・/test-ai はこの接続を再利用する）
+    
+    サーバーに接続できたかどうかを返す。
+    """
+    try:
+        await client.get("http://localhost:8001/health", timeout=5)
+        return True
+    except httpx.HTTPError:
+        return False  # スクリプト実行時は、この後の各チェックで報告される
+
+async def run_buffered(name, test, client):
+    """テストを実行し、(結果, 出力行) を返す（例外は失敗として記録する）"""
+    buf = []
+    _output.set(buf)  # タスクごとにコンテキストが分かれる
+    try:
+        return await test(client), buf
+    except Exception as e:
+        print_test(name, False, str(e))
+        return False, buf
+
+# テスト名: (チェック関数, 前提となるテスト名)。前提は必ず先に並べること
+TESTS = {
+    "Re:lation API": (check_relation_api, ()),
+    "LINE Webhook": (check_line_webhook, ()),
+    "データベース": (check_database_connection, ()),
+    # AI応答はローカルサーバーと RAG 用 DB の両方が動いていないと確認できない
+    "AI応答": (check_ai_response, ("LINE Webhook", "データベース")),
+}
+
+# テスト全体の締め切り（秒）。個々のリクエストの timeout より長く取り、どこかで固まっても全体をここで打ち切る
+SUITE_TIMEOUT = 45
+
+async def run_tests(client, tests=TESTS, timeout=SUITE_TIMEOUT):
+    """前提が成功したテストだけを、前提の完了を待って同時に実行する
+    
+    戻り値は {テスト名: (結果, 出力行)}。前提が失敗したテストは呼び出さず、結果を None にする。
+    timeout 秒を過ぎても終わらないテストはキャンセルして失敗扱いにする。
+    """
+    tasks = {}
+    
+    async def run(name):
+        test, depends_on = tests[name]
+        prerequisites = [(dep, await tasks[dep]) for dep in depends_on]
+        failed = [dep for dep, (ok, _) in prerequisites if not ok]
+        if failed:
+            return None, [f"\n{YELLOW}[スキップ]{ENDC} {name}（前提のテストが失敗: {', '.join(failed)}）"]
+        return await run_buffered(name, test, client)
+    
+    for name in tests:
+        tasks[name] = asyncio.ensure_future(run(name))
+    try:
+        await asyncio.wait_for(asyncio.gather(*tasks.values()), timeout)
+    except asyncio.TimeoutError:
+        pass  # wait_for が gather ごと未完了のタスクをキャンセルし、その完了まで待つ
+    
+    results = {}
+    for name, task in tasks.items():
+        if not task.cancelled():
+            results[name] = task.result()
+            continue
+        buf = []
+        token = _output.set(buf)
+        print_test(name, False, f"全体のタイムアウト（{timeout}秒）までに完了しませんでした")
+        _output.reset(token)
+        results[name] = (False, buf)
+    return results
+
+async def main():
     """メインテスト実行"""
+    setup_logging()
     print(f"{YELLOW}{'='*60}{ENDC}")
     print(f"{YELLOW}   LINE Bot × Re:lation 統合テスト{ENDC}")
     print(f"{YELLOW}{'='*60}{ENDC}")
     print(f"実行時刻: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}")
     
-    # 各テストを実行
+    # 1つのクライアントを共有し、互いに独立なテストは同時に実行する
+    async with make_client() as client:
+        await warm_up(client)
+        outcomes = await run_tests(client)
+    
     results = []
-    results.append(("Re:lation API", test_relation_api()))
-    results.append(("LINE Webhook", test_line_webhook()))
-    results.append(("データベース", test_database_connection()))
-    results.append(("AI応答", test_ai_response()))
+    for name, (result, lines) in outcomes.items():
+        for line in lines:
+            print(line)
+        results.append((name, result))
     
     # 結果サマリー
     print(f"\n{YELLOW}=== テスト結果サマリー ==={ENDC}")
@@ -189,7 +321,10 @@ def main():
     total_count = len(results)
     
     for name, result in results:
-        status = f"{GREEN}✅{ENDC}" if result else f"{RED}❌{ENDC}"
+        if result is None:
+            status = f"{YELLOW}⏭{ENDC}"
+        else:
+            status = f"{GREEN}✅{ENDC}" if result else f"{RED}❌{ENDC}"
         print(f"  {status} {name}")
     
     print(f"\n{BLUE}結果: {success_count}/{total_count} テスト成功{ENDC}")
@@ -204,5 +339,35 @@ def main():
         print(f"{RED}⚠️ 一部のテストが失敗しました{ENDC}")
         print("失敗したテストの詳細を確認してください")
 
+# ====== pytest 用エントリ（pytest test_integration.py） ======
+# 1プロセス・1イベントループ内で全チェックを実行し、クライアントは conftest.py の http を共有する
+if pytest is not None:
+    pytestmark = pytest.mark.asyncio(loop_scope="session")
+
+    # 実行済みテストの結果（False: 失敗 / None: スキップ）。TESTS の前提関係をスクリプト実行時と揃える
+    _results = {}
+
+    async def run_check(name, client, required_env=frozenset()):
+        test, depends_on = TESTS[name]
+        _results[name] = None
+        if missing := missing_env(required_env):
+            pytest.skip(f"環境変数が未設定: {', '.join(sorted(missing))}")
+        if failed := [dep for dep in depends_on if dep in _results and not _results[dep]]:
+            pytest.skip(f"前提のテストが失敗: {', '.join(failed)}")
+        _results[name] = result = await test(client)
+        assert result
+
+    async def test_relation_api(http):
+        await run_check("Re:lation API", http, REQUIRED_RELATION)
+
+    async def test_line_webhook(http, local_server):
+        await run_check("LINE Webhook", http)
+
+    async def test_database_connection(http):
+        await run_check("データベース", http, REQUIRED_SUPABASE)
+
+    async def test_ai_response(http, local_server):
+        await run_check("AI応答", http)
+
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    asyncio.run(main())
\ No newline at end of file
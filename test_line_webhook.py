@@ -1,53 +1,86 @@
 #!/usr/bin/env python3
 """LINE Webhook テスト"""
-import os
-import json
 import hmac
-import hashlib
 import base64
-import requests
-from dotenv import load_dotenv
-
-load_dotenv()
-
-# テスト用のLINEイベント
-test_event = {
-    "events": [{
-        "type": "message",
-        "replyToken": "test_reply_token",
-        "message": {
-            "type": "text",
-            "text": "テストメッセージ"
-        }
-    }]
-}
+import asyncio
+import argparse
+import httpx
+from config import CONFIG
+
+WEBHOOK_URL = "http://localhost:8001/line"
+
+# テスト用のLINEイベント（署名対象のバイト列そのものを固定しておく）
+_TEST_BODY = (
+    '{"events":[{"type":"message","replyToken":"test_reply_token",'
+    '"message":{"type":"text","text":"テストメッセージ"}}]}'
+).encode()
 
-# 署名を生成
-channel_secret = os.getenv("LINE_CHANNEL_SECRET", "").encode()
-body = json.dumps(test_event).encode()
+# 署名を生成（本文は毎回同じなので signature は一度だけ作って使い回す）
+channel_secret = (CONFIG.line_channel_secret or "").encode()
 signature = base64.b64encode(
-    hmac.new(channel_secret, body, hashlib.sha256).digest()
+    hmac.digest(channel_secret, _TEST_BODY, "sha256")
 ).decode()
+HEADERS = {
+    "Content-Type": "application/json",
+    "X-Line-Signature": signature
+}
+
+
+def report(status_code):
+    if status_code == 200:
+        print("✅ Webhook処理成功")
+    elif status_code == 403:
+        print("❌ 署名検証失敗")
+    else:
+        print(f"❌ エラー: {status_code}")
+
+
+async def load_test(count, concurrency):
+    """同じ署名済みリクエストを count 回、最大 concurrency 件並行で送る"""
+    sem = asyncio.Semaphore(concurrency)
+
+    async with httpx.AsyncClient(headers=HEADERS, timeout=30) as client:
+        async def post_once():
+            async with sem:
+                response = await client.post(WEBHOOK_URL, content=_TEST_BODY)
+                return response.status_code
+
+        return await asyncio.gather(*[post_once() for _ in range(count)], return_exceptions=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="LINE Webhook テスト")
+    parser.add_argument("--count", type=int, default=1, help="送信回数（2以上で負荷テスト）")
+    parser.add_argument("--concurrency", type=int, default=8, help="負荷テスト時の同時送信数")
+    args = parser.parse_args()
+
+    print(f"Channel Secret exists: {bool(channel_secret)}")
+    print(f"Generated signature: {signature}")
+
+    if args.count <= 1:
+        # Webhookをテスト
+        response = httpx.post(WEBHOOK_URL, content=_TEST_BODY, headers=HEADERS, timeout=30)
+
+        print(f"Response status: {response.status_code}")
+        print(f"Response body: {response.text}")
+        report(response.status_code)
+        return
+
+    results = asyncio.run(load_test(args.count, args.concurrency))
+
+    # ステータスごとの件数を表示
+    counts = {}
+    for r in results:
+        key = r if isinstance(r, int) else type(r).__name__
+        counts[key] = counts.get(key, 0) + 1
+    print(f"送信数: {args.count} / 同時送信数: {args.concurrency}")
+    for key, n in sorted(counts.items(), key=lambda kv: str(kv[0])):
+        print(f"  {key}: {n}件")
+    if counts.get(200) == args.count:
+        report(200)
+    else:
+        report(next(k for k in counts if k != 200))
+
 
-print(f"Channel Secret exists: {bool(channel_secret)}")
-print(f"Generated signature: {signature}")
-
-# Webhookをテスト
-response = requests.post(
-    "http://localhost:8001/line",
-    data=body,
-    headers={
-        "Content-Type": "application/json",
-        "X-Line-Signature": signature
-    }
-)
-
-print(f"Response status: {response.status_code}")
-print(f"Response body: {response.text}")
-
-if response.status_code == 200:
-    print("✅ Webhook処理成功")
-elif response.status_code == 403:
-    print("❌ 署名検証失敗")
-else:
-    print(f"❌ エラー: {response.status_code}")
\ No newline at end of file
+if __name__ == "__main__":
+    main()
@@ -1,39 +1,68 @@
 #!/usr/bin/env python3
 """Supabaseなしでボットの基本機能をテスト"""
 
-from dotenv import load_dotenv
-load_dotenv()
-
-import os
+import asyncio
+import argparse
+from functools import lru_cache
 from google import genai
 from google.genai import types
+from config import CONFIG
 
 # Gemini APIのみ使用
-API_KEY = os.getenv("GEMINI_API_KEY") or os.getenv("GOOGLE_API_KEY")
+API_KEY = CONFIG.gemini_api_key
 if not API_KEY:
     print("GOOGLE_API_KEY を .env に設定してください")
     exit(1)
 
 gclient = genai.Client(api_key=API_KEY)
 
+MODEL = "gemini-2.0-flash-exp"
+# バッチモードで同時に投げるリクエスト数の上限（レート制限対策）
+BATCH_CONCURRENCY = 8
+
+# プロンプトの定型部分と生成設定は不変なので一度だけ作る
+_PROMPT_TEMPLATE = "カスタマーサポートとして、以下の質問に丁寧に答えてください：\n\n{}"
+_CFG = types.GenerateContentConfig(temperature=0.6)
+
+def build_prompt(user_text: str):
+    return [{"role": "user", "parts": [{"text": _PROMPT_TEMPLATE.format(user_text)}]}]
+
+@lru_cache(maxsize=256)
+def _generate(user_text: str) -> str:
+    """同じ質問の再入力では API を呼ばずに前回の回答を返す（例外はキャッシュされない）"""
+    res = gclient.models.generate_content(
+        model=MODEL,
+        contents=build_prompt(user_text),
+        config=_CFG
+    )
+    return res.text.strip()
+
 def test_reply(user_text: str) -> str:
     """Gemini APIで返答生成（RAGなし）"""
-    prompt = [{
-        "role": "user",
-        "parts": [{"text": f"カスタマーサポートとして、以下の質問に丁寧に答えてください：\n\n{user_text}"}]
-    }]
-    
     try:
-        res = gclient.models.generate_content(
-            model="gemini-2.0-flash-exp",
-            contents=prompt,
-            config=types.GenerateContentConfig(temperature=0.6)
-        )
-        return res.text.strip()
+        return _generate(user_text)
     except Exception as e:
         return f"エラー: {e}"
 
-if __name__ == "__main__":
+async def test_reply_async(user_text: str, sem: asyncio.Semaphore) -> str:
+    """test_reply の非同期版（sem で同時実行数を制限）"""
+    async with sem:
+        try:
+            res = await gclient.aio.models.generate_content(
+                model=MODEL,
+                contents=build_prompt(user_text),
+                config=_CFG
+            )
+            return res.text.strip()
+        except Exception as e:
+            return f"エラー: {e}"
+
+async def run_batch(questions):
+    """質問をまとめて並行に投げ、入力順の回答リストを返す"""
+    sem = asyncio.Semaphore(BATCH_CONCURRENCY)
+    return await asyncio.gather(*[test_reply_async(q, sem) for q in questions])
+
+def interactive():
     print("テストモード（Ctrl+Cで終了）")
     while True:
         try:
@@ -44,4 +73,25 @@ if __name__ == "__main__":
             print(f"回答: {answer}")
         except KeyboardInterrupt:
             break
-    print("\n終了しました")
\ No newline at end of file
+    print("\n終了しました")
+
+def main():
+    parser = argparse.ArgumentParser(description="Supabaseなしでボットの基本機能をテスト")
+    parser.add_argument("--batch", metavar="FILE", help="1行1質問のファイルをまとめて処理する")
+    args = parser.parse_args()
+
+    if not args.batch:
+        interactive()
+        return
+
+    with open(args.batch, encoding="utf-8") as f:
+        questions = [line.strip() for line in f if line.strip()]
+
+    answers = asyncio.run(run_batch(questions))
+    for q, a in zip(questions, answers):
+        print(f"\n質問: {q}")
+        print(f"回答: {a}")
+    print(f"\n{len(questions)}件処理しました")
+
+if __name__ == "__main__":
+    main()
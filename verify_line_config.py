@@ -1,49 +1,57 @@
 #!/usr/bin/env python3
 """LINE設定確認スクリプト"""
-import os
-import requests
-from dotenv import load_dotenv
+import json
+import asyncio
+import httpx
+from config import CONFIG
+try:
+    from orjson import loads as json_loads  # 任意: 高速な JSON パーサ
+except ImportError:
+    json_loads = json.loads
+
+
+async def fetch_line_settings(token):
+    """Webhook 設定と Bot 情報を1つの接続で同時に取得する"""
+    async with httpx.AsyncClient(
+        base_url="https://api.line.me",
+        headers={"Authorization": f"Bearer {token}"},
+        http2=True,  # 2本のリクエストを1本の TLS 接続に多重化する
+        timeout=10
+    ) as client:
+        return await asyncio.gather(
+            client.get("/v2/bot/channel/webhook/endpoint"),
+            client.get("/v2/bot/info"),
+        )
 
-load_dotenv()
 
 print("=" * 60)
 print("LINE Bot 設定確認")
 print("=" * 60)
 
 # 環境変数チェック
-channel_secret = os.getenv("LINE_CHANNEL_SECRET")
-channel_token = os.getenv("LINE_CHANNEL_TOKEN")
+channel_secret = CONFIG.line_channel_secret
+channel_token = CONFIG.line_channel_token
 
 print(f"✅ Channel Secret: {'設定済み' if channel_secret else '❌ 未設定'}")
 print(f"✅ Channel Token: {'設定済み' if channel_token else '❌ 未設定'}")
 
 if channel_token:
-    # LINE APIで設定を確認
-    headers = {"Authorization": f"Bearer {channel_token}"}
-    
-    # Webhook エンドポイント情報を取得
-    response = requests.get(
-        "https://api.line.me/v2/bot/channel/webhook/endpoint",
-        headers=headers
-    )
+    # LINE APIで設定を確認（Webhook エンドポイント情報 / Bot情報）
+    webhook_response, info_response = asyncio.run(fetch_line_settings(channel_token))
     
+    response = webhook_response
     print(f"\n📡 Webhook設定状態:")
     if response.status_code == 200:
-        data = response.json()
+        data = json_loads(response.content)
         print(f"  - エンドポイント: {data.get('endpoint', '未設定')}")
         print(f"  - アクティブ: {data.get('active', False)}")
     else:
         print(f"  ❌ 取得失敗: {response.status_code}")
     
-    # Bot情報を取得
-    response = requests.get(
-        "https://api.line.me/v2/bot/info",
-        headers=headers
-    )
-    
+    response = info_response
     print(f"\n🤖 Bot情報:")
     if response.status_code == 200:
-        data = response.json()
+        data = json_loads(response.content)
         print(f"  - 表示名: {data.get('displayName', '不明')}")
         print(f"  - Bot ID: {data.get('userId', '不明')}")
         print(f"  - 画像URL: {data.get('pictureUrl', '未設定')}")